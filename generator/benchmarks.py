@@ -0,0 +1,330 @@
+# microbenchmarks for the markov generator
+# run with: python manage.py benchmark [name ...]
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connection
+
+from generator.markov import MarkovModel, ArrayMarkovModel, SuffixArrayIndex, parallel_model, ENGINES, \
+	TokenMarkovModel
+from generator.models import Text, Quotation, ORDER
+from generator import cleanup, modelfile
+
+import cPickle
+import random
+import re
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+
+WORDS = ("the world is full of objects more or less interesting I do not wish "
+	"to add any more quotation and originality a rabbit as king of ghosts work "
+	"art in age mechanical reproduction ecstasy influence plagiarism tradition "
+	"individual talent unoriginal genius special type choice object made by men "
+	"garden forking paths sandman").split()
+
+# synthetic prose of roughly `size` characters, deterministic for a given seed
+def corpus(size, seed=0):
+	rng = random.Random(seed)
+	parts = []
+	length = 0
+	while length < size:
+		sentence = ' '.join(rng.choice(WORDS) for i in range(rng.randint(4, 20)))
+		sentence = sentence[0].upper() + sentence[1:] + rng.choice('...!?') + ' '
+		if rng.random() < 0.1:
+			sentence += '\n'
+		parts.append(sentence)
+		length += len(sentence)
+	return ''.join(parts)[:size]
+
+def timeit(func, repeat=3):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		func()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+# per-character sampling cost, dict walk vs compiled bisect
+def sampling(size=1000000, order=6, steps=100000):
+	content = corpus(size)
+	dictmodel = MarkovModel(content, order)
+	compiled = dictmodel.compile()
+	def walk(model):
+		kgram = content[:order]
+		for i in xrange(steps):
+			kgram = kgram[1:] + model.random(kgram)
+	results = []
+	for name, model in (('dict', dictmodel), ('compiled', compiled)):
+		seconds = timeit(lambda: walk(model))
+		results.append((name, seconds / steps * 1e6, 'us/char'))
+	return results
+
+
+# approximate bytes held by a kgram dictionary and everything in it
+def dictsize(model):
+	total = sys.getsizeof(model)
+	for kgram, successors in model.iteritems():
+		total += sys.getsizeof(kgram) + sys.getsizeof(successors)
+		for char, count in successors.iteritems():
+			total += sys.getsizeof(char) + sys.getsizeof(count)
+	return total
+
+# memory footprint and sampling cost of the nested dict vs the array engine
+def memory(size=1000000, order=6, steps=100000):
+	content = corpus(size)
+	dictmodel = MarkovModel(content, order)
+	arraymodel = ArrayMarkovModel.from_counts(order, dictmodel.model)
+	def walk(model):
+		kgram = content[:order]
+		for i in xrange(steps):
+			kgram = kgram[1:] + model.random(kgram)
+	return [
+		('dict', dictsize(dictmodel.model) / 1e6, 'MB'),
+		('array', arraymodel.nbytes() / 1e6, 'MB'),
+		('array sampling', timeit(lambda: walk(arraymodel)) / steps * 1e6, 'us/char'),
+	]
+
+
+# one suffix array index vs a dict model per order
+def index(size=200000, orders=(3, 6, 9)):
+	content = corpus(size)
+	results = [('suffix array build', timeit(lambda: SuffixArrayIndex(content), 1), 's')]
+	for k in orders:
+		results.append(('dict build order %d' % k, timeit(lambda: MarkovModel(content, k), 1), 's'))
+	return results
+
+
+# per-request cost of getting a model and generating one quote: unpickling
+# the cached value (what a memcached hit costs) vs a mapped model file
+def modelfiles(size=1000000, requests=20):
+	content = corpus(size)
+	model = ArrayMarkovModel.from_content(content, ORDER)
+	pickled = cPickle.dumps(model, cPickle.HIGHEST_PROTOCOL)
+	directory = tempfile.mkdtemp()
+	try:
+		modelfile.write(modelfile.path(directory, 0, ORDER, 1), model)
+		def pickle_requests():
+			for i in range(requests):
+				Text.generatequote(content, 50, cPickle.loads(pickled))
+		def mmap_requests():
+			for i in range(requests):
+				Text.generatequote(content, 50, modelfile.open_model(directory, 0, ORDER, 1, None))
+		def cold_open():
+			modelfile.MmapMarkovModel(modelfile.path(directory, 0, ORDER, 1)).close()
+		return [
+			('pickle request', timeit(pickle_requests) / requests * 1e3, 'ms'),
+			('mmap request', timeit(mmap_requests) / requests * 1e3, 'ms'),
+			('mmap cold open', timeit(cold_open) * 1e3, 'ms'),
+			('pickled size', len(pickled) / 1e6, 'MB'),
+		]
+	finally:
+		for filename, identity, mapped in modelfile.mapped.values():
+			mapped.close()
+		modelfile.mapped.clear()
+		shutil.rmtree(directory)
+
+
+# quotes per second generating one quote per model load (what the add view
+# does) vs a batch of 100 from one load
+def batch(size=1000000, quotes=100):
+	content = corpus(size)
+	pickled = cPickle.dumps(ArrayMarkovModel.from_content(content, ORDER), cPickle.HIGHEST_PROTOCOL)
+	def singles():
+		for i in range(quotes):
+			Text.generate_many(ORDER, 50, content, 1, cPickle.loads(pickled))
+	def batched():
+		Text.generate_many(ORDER, 50, content, quotes, cPickle.loads(pickled))
+	return [
+		('n=1', quotes / timeit(singles, 1), 'quotes/s'),
+		('n=%d' % quotes, quotes / timeit(batched, 1), 'quotes/s'),
+	]
+
+
+# runs func against a throwaway test database
+def with_test_database(func):
+	name = settings.DATABASES['default']['NAME']
+	connection.creation.create_test_db(verbosity=0)
+	try:
+		return func()
+	finally:
+		connection.creation.destroy_test_db(name, verbosity=0)
+
+# cost of a page deep in the feed as the quotation table grows: loading every
+# quote and paginating in python (the old feeds) vs a keyset page
+def feeds(sizes=(1000, 10000, 100000)):
+	from generator import views
+	def run():
+		user = User.objects.create_user(username='bench', password='bench')
+		results = []
+		for size in sizes:
+			while Quotation.objects.count() < size:
+				batch = min(1000, size - Quotation.objects.count())
+				Quotation.objects.bulk_create([Quotation(quote=corpus(200, i), user=user) for i in range(batch)])
+			middle = Quotation.objects.order_by('-created', '-id')[size // 2]
+			cursor = views.encode_cursor(middle)
+			def paginated():
+				quotes = list(Quotation.objects.all().order_by('-created'))
+				list(Paginator(quotes, views.PAGESIZE).page(size // 2 // views.PAGESIZE))
+			def keyset():
+				views.all_quotes(after=cursor, update=True)
+			results.append(('paginated %d' % size, timeit(paginated, 1) * 1e3, 'ms'))
+			results.append(('keyset %d' % size, timeit(keyset) * 1e3, 'ms'))
+		return results
+	return with_test_database(run)
+
+# fetching a cached model, from memcached (unpickling it each time) vs the
+# per-process tier
+def tiers(size=1000000, requests=20):
+	from generator import caching
+	model = ArrayMarkovModel.from_content(corpus(size), ORDER)
+	def fetch(local):
+		@caching.memoize(lambda n: 'benchtier%d' % n, large=True, local=local)
+		def load(n):
+			return model
+		load(local)
+		return lambda: [load(local) for i in range(requests)]
+	return [
+		('memcached', timeit(fetch(False)) * 1e3 / requests, 'ms/request'),
+		('local', timeit(fetch(True)) * 1e3 / requests, 'ms/request'),
+	]
+
+# a model of pasted (unsaved) text: built on every click vs cached by digest
+def adhoc(size=200000):
+	from generator import builds
+	content = corpus(size)
+	builds.model_for(content, ORDER)
+	return [
+		('build', timeit(lambda: builds.build(content, ORDER), 1) * 1e3, 'ms'),
+		('cached', timeit(lambda: builds.model_for(content, ORDER)) * 1e3, 'ms'),
+	]
+
+# building the model of a book-length text, serially and across processes
+def parallel(size=5000000, order=ORDER):
+	import multiprocessing
+	content = corpus(size)
+	results = [('serial', timeit(lambda: MarkovModel(content, order), 1), 's')]
+	processes = 2
+	while processes <= max(2, multiprocessing.cpu_count()):
+		results.append(('%d processes' % processes,
+			timeit(lambda: parallel_model(content, order, processes), 1), 's'))
+		processes *= 2
+	return results
+
+# building and sampling with each engine
+def engines(size=1000000, order=ORDER, steps=100000):
+	content = corpus(size)
+	results = []
+	for name, build in sorted(ENGINES.items()):
+		model = build(content, order)
+		def walk():
+			kgram = content[:order]
+			for i in xrange(steps):
+				kgram = kgram[1:] + model.random(kgram)
+		results.append(('%s build' % name, timeit(lambda: build(content, order), 1), 's'))
+		results.append(('%s sampling' % name, timeit(walk, 1) * 1e6 / steps, 'us/char'))
+	return results
+
+# character vs token chains: sampling steps and time per quote, and the
+# number of kgrams in the table
+def tokens(size=1000000, quotes=200):
+	content = corpus(size).decode('ascii')
+	results = []
+	for name, order, model in (('char', ORDER, ArrayMarkovModel.from_content(content, ORDER)),
+			('word', 2, TokenMarkovModel(content, 2, 'word')),
+			('hybrid', 3, TokenMarkovModel(content, 3, 'hybrid'))):
+		steps = [0]
+		sample = model.random
+		def counted(kgram, rng=None):
+			steps[0] += 1
+			return sample(kgram, rng)
+		model.random = counted
+		elapsed = timeit(lambda: Text.generate_many(order, 50, content, quotes, model, 0), 1)
+		del model.random
+		results.append(('%s order %d steps' % (name, order), float(steps[0]) / quotes, 'steps/quote'))
+		results.append(('%s order %d time' % (name, order), elapsed * 1e3 / quotes, 'ms/quote'))
+		results.append(('%s order %d table' % (name, order), len(model), 'kgrams'))
+	return results
+
+# the regex and slicing cleanup Text.chain used to run, for comparison
+def regex_cleanup(output):
+	output = re.sub(r'(\"(?=\S)[^\"]*(?<=\S)\")|\"', lambda m: m.group(1) or '', output)
+	if output[-1] == '.':
+		return output
+	while output[-1] not in string.letters and len(output) > 0:
+		if output[-1] == '.':
+			return output
+		output = output[:-1]
+	return output + '.'
+
+# cleaning generated output: a typical quote and one with a long unpunctuated
+# tail, regex and slicing vs the one-pass filters
+def cleanups(repeat=1000):
+	typical = corpus(300, 1) + ' "and so ,'
+	tail = corpus(300, 2) + ' ,;-' * 2000
+	results = []
+	for name, text in (('typical', typical), ('long tail', tail)):
+		results.append(('%s regex' % name, timeit(lambda: [regex_cleanup(text) for i in xrange(repeat)]) * 1e6 / repeat, 'us'))
+		results.append(('%s one-pass' % name, timeit(lambda: [cleanup.clean_text(text) for i in xrange(repeat)]) * 1e6 / repeat, 'us'))
+		results.append(('%s streaming' % name, timeit(lambda: [u''.join(cleanup.clean(text)) for i in xrange(repeat)]) * 1e6 / repeat, 'us'))
+	return results
+
+# the end-to-end suite on synthetic corpora from 10 KB to 10 MB: building a
+# model, loading it from the cache, sampling from it, and the add page
+# generating from the saved text. corpora and generation are seeded, so runs
+# on different commits do the same work (compare them with benchmark --json
+# and --compare). a model too big for the cache gets no cache load result
+SUITE_SIZES = (10 * 1000, 100 * 1000, 1000 * 1000, 10 * 1000 * 1000)
+
+def suite(sizes=SUITE_SIZES, order=ORDER, steps=20000, requests=5):
+	from django.test.client import Client
+	from generator import caching
+	def run():
+		random.seed(0)
+		user = User.objects.create_user(username='bench', password='bench')
+		client = Client()
+		client.login(username='bench', password='bench')
+		results = []
+		for size in sizes:
+			label = '%dKB' % (size // 1000)
+			content = corpus(size)
+			results.append((label + ' build', timeit(lambda: ArrayMarkovModel.from_content(content, order), 1), 's'))
+			model = ArrayMarkovModel.from_content(content, order)
+			if caching.set_large('benchsuite', model):
+				results.append((label + ' cache load', timeit(lambda: caching.get_large('benchsuite')) * 1e3, 'ms'))
+			rng = random.Random(0)
+			def walk():
+				kgram = content[:order]
+				for i in xrange(steps):
+					kgram = kgram[1:] + model.random(kgram, rng)
+			results.append((label + ' sampling', timeit(walk, 1) * 1e6 / steps, 'us/char'))
+			text = Text.objects.create_text(content, 'bench', 'bench', user)
+			post = {'generate': '1', 'content': content, 'text_id': text.pk, 'order': order, 'seed': 0}
+			# the first request loads the model; the rest are timed
+			client.post('/add/', post)
+			results.append((label + ' add POST', timeit(lambda: client.post('/add/', post), requests) * 1e3, 'ms'))
+		return results
+	return with_test_database(run)
+
+
+BENCHMARKS = {
+	'sampling': sampling,
+	'memory': memory,
+	'index': index,
+	'modelfiles': modelfiles,
+	'batch': batch,
+	'feeds': feeds,
+	'tiers': tiers,
+	'adhoc': adhoc,
+	'parallel': parallel,
+	'engines': engines,
+	'tokens': tokens,
+	'cleanup': cleanups,
+	'suite': suite,
+}
@@ -0,0 +1,194 @@
+# markov models of unsaved text, built off the request path
+#
+# builds are handed to a pool of worker processes and keyed by a digest of
+# the content and order, so clicking generate again on the same text joins
+# the build already running instead of starting another. finished models are
+# cached under the same digest in memcached, for any web worker to reuse, and
+# in a size-bounded LRU in this worker, so repeat generations from the same
+# paste skip the build and the fetch.
+from django.conf import settings
+
+from generator import instrument
+from generator.caching import get_large, set_large, LocalCache
+from generator.markov import SuffixArrayIndex, TOKEN_ENGINES, build_model
+
+import cPickle
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# how long a finished model stays cached
+TIMEOUT = 60 * 60
+
+# engine names the builder (see markov.ENGINES and TOKEN_ENGINES);
+# settings.MARKOV_ENGINE if None. INDEX builds a suffix array index, which
+# serves every order (order is 0)
+INDEX = 'index'
+
+def engine_name(engine=None):
+	return engine or getattr(settings, 'MARKOV_ENGINE', 'compiled')
+
+def digest(content, order, engine=None):
+	return hashlib.sha1('%d:%s:%s' % (order, engine_name(engine), content.encode('utf-8'))).hexdigest()
+
+def key(content, order, engine=None):
+	return 'build:' + digest(content, order, engine)
+
+# runs in a pool process
+def build(content, order, engine=None):
+	if engine == INDEX:
+		return SuffixArrayIndex(content)
+	if engine in TOKEN_ENGINES:
+		return TOKEN_ENGINES[engine](content, order)
+	return build_model(content, order, engine_name(engine))
+
+
+# finished models in this process by digest (content-addressed, so the digest
+# is also the version)
+models = LocalCache(getattr(settings, 'ADHOC_MODEL_BYTES', 32 * 1024 * 1024))
+
+def sizeof(model):
+	if hasattr(model, 'nbytes'):
+		return model.nbytes()
+	return len(cPickle.dumps(model, cPickle.HIGHEST_PROTOCOL))
+
+# finished indexes are also kept on disk next to the model files, as those of
+# long texts outgrow a memcached value and the local tier. the least recently
+# used files beyond INDEX_FILES are removed
+INDEX_FILES = 50
+
+def index_path(name):
+	directory = getattr(settings, 'MARKOV_MODEL_DIR', None)
+	return directory and os.path.join(directory, 'index-%s.pickle' % name)
+
+def load_index(name):
+	filename = index_path(name)
+	if not filename:
+		return None
+	try:
+		with open(filename, 'rb') as f:
+			index = cPickle.load(f)
+		os.utime(filename, None)
+		return index
+	except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+		return None
+
+def save_index(name, index):
+	filename = index_path(name)
+	if not filename:
+		return
+	directory = os.path.dirname(filename)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.tmp')
+	with os.fdopen(fd, 'wb') as f:
+		cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+	os.rename(tmppath, filename)
+	files = []
+	for path in glob.glob(os.path.join(directory, 'index-*.pickle')):
+		try:
+			files.append((os.path.getmtime(path), path))
+		except OSError:
+			pass
+	for mtime, path in sorted(files)[:-INDEX_FILES]:
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+# the finished model of content at order, or None
+def cached(content, order, engine=None):
+	name = digest(content, order, engine)
+	model = models.get(name, name)
+	if model is None:
+		model = get_large(key(content, order, engine))
+		if model is None and engine == INDEX:
+			model = load_index(name)
+		if model is not None:
+			models.set(name, name, model, sizeof(model))
+	return model
+
+def remember(content, order, model, engine=None):
+	name = digest(content, order, engine)
+	set_large(key(content, order, engine), model, TIMEOUT)
+	models.set(name, name, model, sizeof(model))
+	if engine == INDEX:
+		save_index(name, model)
+
+# the model of content at order, built here and now if it isn't cached
+def model_for(content, order, engine=None):
+	model = cached(content, order, engine)
+	if model is None:
+		with instrument.timer('build'):
+			model = build(content, order, engine)
+		remember(content, order, model, engine)
+	return model
+
+
+# this process's pool (created on first use, so each forked web worker gets
+# its own) and its running builds by digest
+pool = None
+jobs = {}
+lock = threading.Lock()
+
+def get_pool():
+	global pool
+	if pool is None:
+		pool = multiprocessing.Pool(getattr(settings, 'MODEL_BUILD_WORKERS', 2))
+	return pool
+
+# callback publishing a finished build as soon as it is done, so a worker
+# asked for the same content next finds it cached and an abandoned build
+# isn't kept alive in jobs. it runs in the pool's result thread, which an
+# exception would kill
+def finished(name, content, order, engine=None):
+	def callback(model):
+		try:
+			remember(content, order, model, engine)
+		except Exception:
+			log.exception('caching built model failed')
+		finally:
+			with lock:
+				jobs.pop(name, None)
+	return callback
+
+# starts building the model of content at order unless it is cached or
+# already building
+def submit(content, order, engine=None):
+	name = digest(content, order, engine)
+	with lock:
+		if name in jobs or cached(content, order, engine) is not None:
+			return
+		jobs[name] = get_pool().apply_async(build, (content, order, engine),
+			callback=finished(name, content, order, engine))
+
+# the model of content at order, waiting up to wait seconds for it to be
+# built; None if it isn't ready by then. a failed build raises its error
+# (and can be submitted again)
+def built_model(content, order, wait=0, engine=None):
+	model = cached(content, order, engine)
+	if model is not None:
+		return model
+	submit(content, order, engine)
+	name = digest(content, order, engine)
+	with lock:
+		job = jobs.get(name)
+	if job is None:
+		# finished in the meantime
+		return cached(content, order, engine)
+	job.wait(wait)
+	if not job.ready():
+		return None
+	try:
+		# a finished build was published by its callback already
+		return job.get()
+	finally:
+		with lock:
+			jobs.pop(name, None)
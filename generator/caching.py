@@ -0,0 +1,268 @@
+# cache helpers for values too big for one memcached item
+#
+# values are pickled and zlib-compressed. a value that fits in one item is
+# stored under its key directly; a bigger one is split across numbered chunk
+# keys, and its key holds a manifest naming them. chunk keys carry a token
+# unique to each write, so a reader never mixes chunks of two writes.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from collections import OrderedDict
+from generator import instrument
+
+import cPickle
+import functools
+import random
+import threading
+import time
+import uuid
+import zlib
+
+
+# memcached rejects items over 1 MB; leave room for the key and flags
+CHUNKSIZE = 1000 * 1000 - 1024
+# values needing more chunks than this are not cached at all
+MAXCHUNKS = 32
+
+# per-process counters: values stored whole or in chunks, values rejected as
+# oversize, and lookups that found a value or missed (including broken chunks);
+# for memoized helpers, stale values served while refreshing, and callers that
+# waited for another's computation
+stats = {'stored': 0, 'chunked': 0, 'rejected': 0, 'hits': 0, 'misses': 0, 'stale': 0, 'waits': 0}
+
+
+def chunkkeys(key, token, count):
+	return ['%s:%s:%d' % (key, token, i) for i in range(count)]
+
+@instrument.timed('cache')
+def set_large(key, value, timeout=None):
+	data = zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+	if len(data) <= CHUNKSIZE:
+		cache.set(key, ('v', data), timeout)
+		stats['stored'] += 1
+		return True
+	count = (len(data) + CHUNKSIZE - 1) // CHUNKSIZE
+	if count > MAXCHUNKS:
+		# don't leave an older value behind to be served instead
+		cache.delete(key)
+		stats['rejected'] += 1
+		return False
+	token = uuid.uuid4().hex[:8]
+	keys = chunkkeys(key, token, count)
+	cache.set_many(dict((k, data[i*CHUNKSIZE:(i+1)*CHUNKSIZE]) for i, k in enumerate(keys)), timeout)
+	# the manifest goes last, so it only ever names chunks that were written
+	cache.set(key, ('c', token, count), timeout)
+	stats['chunked'] += 1
+	return True
+
+def get_large(key):
+	return load_large(key)[0]
+
+# value under key and its pickled size, or (None, 0)
+@instrument.timed('cache')
+def load_large(key):
+	entry = cache.get(key)
+	# anything else under the key predates this layout
+	if not isinstance(entry, tuple):
+		stats['misses'] += 1
+		return None, 0
+	if entry[0] == 'v':
+		data = entry[1]
+	else:
+		token, count = entry[1:]
+		keys = chunkkeys(key, token, count)
+		chunks = cache.get_many(keys)
+		if len(chunks) != count:
+			stats['misses'] += 1
+			return None, 0
+		data = ''.join(chunks[k] for k in keys)
+	stats['hits'] += 1
+	data = zlib.decompress(data)
+	return cPickle.loads(data), len(data)
+
+# deletes keys, along with the versions of any kept in the local tier
+def delete(keys):
+	cache.delete_many([key + ':ver' for key in keys] + list(keys))
+
+
+# per-process tier in front of memcached, bounded by the pickled size of the
+# values it holds and evicting the least recently used. each value is kept
+# with the version memcached had for its key, and is only served while
+# memcached still has that version, so a write or delete from any worker is
+# seen at the cost of fetching one small key rather than the whole value
+class LocalCache(object):
+	def __init__(self, maxbytes):
+		self.maxbytes = maxbytes
+		self.entries = OrderedDict()
+		self.nbytes = 0
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key, version):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None or entry[0] != version:
+				if entry is not None:
+					self.nbytes -= entry[2]
+				self.stats['misses'] += 1
+				return None
+			self.entries[key] = entry
+			self.stats['hits'] += 1
+			return entry[1]
+
+	def set(self, key, version, value, size):
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.nbytes -= old[2]
+			if size > self.maxbytes:
+				return
+			self.entries[key] = (version, value, size)
+			self.nbytes += size
+			while self.nbytes > self.maxbytes:
+				old = self.entries.popitem(last=False)[1]
+				self.nbytes -= old[2]
+				self.stats['evictions'] += 1
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.nbytes = 0
+
+localcache = LocalCache(getattr(settings, 'LOCAL_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+# namespaces: keys in a namespace embed its version, so bumping the version
+# retires every key in it with a single cache operation. versions start at
+# random, so one evicted and restarted doesn't bring back old keys
+NAMESPACE_TIMEOUT = 60 * 60 * 24 * 30
+
+def namespace_version(namespace):
+	key = 'ns:' + namespace
+	version = cache.get(key)
+	if version is None:
+		cache.add(key, random.getrandbits(48), NAMESPACE_TIMEOUT)
+		version = cache.get(key)
+	# a cache that keeps nothing can't keep the namespace's keys either
+	return 0 if version is None else version
+
+def bump_namespace(namespace):
+	try:
+		cache.incr('ns:' + namespace)
+	except ValueError:
+		cache.set('ns:' + namespace, random.getrandbits(48), NAMESPACE_TIMEOUT)
+
+# key of name in namespace at its current version
+def namespaced(namespace, name=''):
+	return '%s:v%d:%s' % (namespace, namespace_version(namespace), name)
+
+
+# memoized cache helpers
+#
+# func(*args) is cached under keyfunc(*args); callers pass update=True to
+# recompute it. an entry is fresh for soft seconds. after that the stale value
+# is still served while one caller, holding a lock taken with cache.add,
+# recomputes it in the background (stale-while-revalidate). on a miss only the
+# lock holder computes the value and the others wait for it, so an expired
+# model is built once rather than by every worker at the same time. waiters
+# wait as long as the lock is held (up to its timeout), and one of them takes
+# over if it is released with no value stored.
+# with local=True (large values only) entries are also kept in the local tier
+LOCK_TIMEOUT = 60
+POLL = 0.05
+# refresh stale entries in a background thread (off for tests)
+BACKGROUND = True
+
+def memoize(keyfunc, soft=300, timeout=60 * 60 * 24, large=False, local=False):
+	get, put = (get_large, set_large) if large else (instrument.timed('cache')(cache.get), instrument.timed('cache')(cache.set))
+	def valid(entry):
+		return isinstance(entry, tuple) and len(entry) == 2
+
+	def fetch(key):
+		if not local:
+			return get(key)
+		version = cache.get(key + ':ver')
+		entry = None if version is None else localcache.get(key, version)
+		if entry is None:
+			entry, size = load_large(key)
+			if version is not None and valid(entry):
+				localcache.set(key, version, entry, size)
+		return entry
+
+	def save(key, entry):
+		put(key, entry, timeout)
+		# the version goes last, so it never names an older value
+		if local:
+			cache.set(key + ':ver', uuid.uuid4().hex[:8], timeout)
+
+	def decorator(func):
+		def compute(key, args):
+			value = func(*args)
+			save(key, (value, time.time() + soft))
+			return value
+
+		def refresh(key, args):
+			try:
+				compute(key, args)
+			finally:
+				cache.delete(key + ':lock')
+				if BACKGROUND:
+					connection.close()
+
+		@functools.wraps(func)
+		def memoized(*args, **kwargs):
+			key = keyfunc(*args)
+			if kwargs.get('update'):
+				return compute(key, args)
+			entry = fetch(key)
+			if valid(entry):
+				value, fresh_until = entry
+				if time.time() > fresh_until and cache.add(key + ':lock', 1, LOCK_TIMEOUT):
+					stats['stale'] += 1
+					if BACKGROUND:
+						threading.Thread(target=refresh, args=(key, args)).start()
+					else:
+						refresh(key, args)
+				return value
+			if cache.add(key + ':lock', 1, LOCK_TIMEOUT):
+				try:
+					return compute(key, args)
+				finally:
+					cache.delete(key + ':lock')
+			# someone else is computing it: wait for their result
+			stats['waits'] += 1
+			deadline = time.time() + LOCK_TIMEOUT
+			while time.time() < deadline:
+				if cache.get(key + ':lock') is None:
+					if cache.add(key + ':lock', 1, LOCK_TIMEOUT):
+						try:
+							return compute(key, args)
+						finally:
+							cache.delete(key + ':lock')
+					if cache.get(key + ':lock') is None:
+						# the cache keeps nothing (unreachable, or a dummy
+						# backend): no lock can be held, so don't wait for one
+						return compute(key, args)
+				time.sleep(POLL)
+				entry = fetch(key)
+				if valid(entry):
+					return entry[0]
+			return compute(key, args)
+
+		# the cached value for args, or None, without computing it
+		def peek(*args):
+			entry = fetch(keyfunc(*args))
+			return entry[0] if valid(entry) else None
+
+		# caches value as the result for args
+		def store(value, *args):
+			save(keyfunc(*args), (value, time.time() + soft))
+
+		memoized.peek = peek
+		memoized.store = store
+		return memoized
+	return decorator
@@ -0,0 +1,148 @@
+# cleanup of generated text in one pass. clean_text cleans a whole quote,
+# with one compiled regex pass and work proportional to its tail and brackets;
+# for streamed output, clean does the same as the markov chain walks, each of
+# its filters taking and yielding characters and holding back only what it
+# can't decide on yet.
+import re
+
+
+# whitespace as matched by \s in the (non-unicode) cleanup regex
+WHITESPACE = ' \t\n\r\f\v'
+# characters that end a sentence
+TERMINATORS = '.!?'
+# characters that may close a sentence after its terminator
+CLOSERS = '"\')'
+
+QUOTES = re.compile(r'(\"(?=\S)[^\"]*(?<=\S)\")|\"')
+PARENS = re.compile(r'[()]')
+
+# the whole cleanup: trims the tail, then drops unpaired quotes and brackets
+def clean_text(text):
+	text = QUOTES.sub(lambda m: m.group(1) or '', trim_text(text))
+	return balance_parens(text)
+
+# the same, streaming
+def clean(chars):
+	return unpaired_parens(unpaired_quotes(trim_tail(chars)))
+
+# whole-text trim_tail
+def trim_text(text):
+	end = len(text)
+	while end and not text[end-1].isalpha():
+		end -= 1
+	tail = text[end:]
+	cut = max(tail.rfind(terminator) for terminator in TERMINATORS) + 1
+	if not cut:
+		return text[:end] + '.'
+	while cut < len(tail) and tail[cut] in CLOSERS:
+		cut += 1
+	return text[:end] + tail[:cut]
+
+# whole-text unpaired_parens
+def balance_parens(text):
+	opened = []
+	unpaired = []
+	for match in PARENS.finditer(text):
+		if match.group() == '(':
+			opened.append(match.start())
+		elif opened:
+			opened.pop()
+		else:
+			unpaired.append(match.start())
+	unpaired = sorted(unpaired + opened)
+	if not unpaired:
+		return text
+	pieces = []
+	start = 0
+	for pos in unpaired:
+		pieces.append(text[start:pos])
+		start = pos + 1
+	pieces.append(text[start:])
+	return u''.join(pieces)
+
+# drops unpaired double quotes: a quote is kept only with a matching closing
+# quote, the quoted text neither starting nor ending with whitespace
+def unpaired_quotes(chars):
+	quoted = None
+	for char in chars:
+		if quoted is None:
+			if char == '"':
+				quoted = []
+			else:
+				yield char
+		elif char != '"':
+			quoted.append(char)
+		elif not quoted or (quoted[0] not in WHITESPACE and quoted[-1] not in WHITESPACE):
+			yield '"'
+			for c in quoted:
+				yield c
+			yield '"'
+			quoted = None
+		else:
+			# the opening quote is unpaired; this one may open a new pair
+			for c in quoted:
+				yield c
+			quoted = []
+	if quoted is not None:
+		for c in quoted:
+			yield c
+
+# drops unpaired parentheses: closing ones with nothing open, and opening ones
+# never closed (keeping the text after them)
+def unpaired_parens(chars):
+	# text after each open parenthesis, innermost last
+	opened = []
+	for char in chars:
+		if char == '(':
+			opened.append([])
+		elif char == ')':
+			if not opened:
+				continue
+			inner = ['('] + opened.pop() + [')']
+			if opened:
+				opened[-1].extend(inner)
+			else:
+				for c in inner:
+					yield c
+		elif opened:
+			opened[-1].append(char)
+		else:
+			yield char
+	for inner in opened:
+		for c in inner:
+			yield c
+
+# ends the text at a sentence: trailing characters after the last letter are
+# dropped back to the last terminator among them (with any closing quotes or
+# brackets right after it), and a period is added if there is none
+def trim_tail(chars):
+	held = []
+	for char in chars:
+		if char.isalpha():
+			for c in held:
+				yield c
+			held = []
+			yield char
+		else:
+			held.append(char)
+	end = len(held)
+	while end and held[end-1] not in TERMINATORS:
+		end -= 1
+	if not end:
+		yield '.'
+		return
+	while end < len(held) and held[end] in CLOSERS:
+		end += 1
+	for c in held[:end]:
+		yield c
+
+# groups characters into strings of up to size characters
+def chunks(chars, size=16):
+	buf = []
+	for char in chars:
+		buf.append(char)
+		if len(buf) >= size:
+			yield u''.join(buf)
+			buf = []
+	if buf:
+		yield u''.join(buf)
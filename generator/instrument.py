@@ -0,0 +1,159 @@
+# lightweight timing of the hot paths
+#
+# timer(name) times a block (timed(name) a function) and adds it to the
+# current request's breakdown and to this process's histogram for name.
+# TimingMiddleware opens the breakdown for each request, times its queries
+# (durations only, no sql is kept), and reports it as a Server-Timing header
+# and one structured log line.
+# nested timers each count in full: 'model' includes the 'cache' it spends.
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from functools import wraps
+import json
+import logging
+import threading
+import time
+
+
+log = logging.getLogger('generator.timing')
+
+# histogram bucket upper bounds, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+# this process's histograms by name: [count, total ms, bucket counts]
+histograms = {}
+lock = threading.Lock()
+# the current request's breakdown (name -> [total ms, count]), if any
+current = threading.local()
+
+def record(name, ms):
+	with lock:
+		histogram = histograms.get(name)
+		if histogram is None:
+			histogram = histograms[name] = [0, 0.0, [0] * len(BUCKETS)]
+		histogram[0] += 1
+		histogram[1] += ms
+		bucket = 0
+		while ms > BUCKETS[bucket]:
+			bucket += 1
+		histogram[2][bucket] += 1
+	breakdown = getattr(current, 'breakdown', None)
+	if breakdown is not None:
+		entry = breakdown.setdefault(name, [0.0, 0])
+		entry[0] += ms
+		entry[1] += 1
+
+class timer(object):
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		record(self.name, (time.time() - self.start) * 1000)
+
+def timed(name):
+	def decorator(func):
+		@wraps(func)
+		def timedfunc(*args, **kwargs):
+			with timer(name):
+				return func(*args, **kwargs)
+		return timedfunc
+	return decorator
+
+# upper bound of the bucket holding the given fraction of a histogram (None
+# past the last bound)
+def percentile(histogram, fraction):
+	count, total, buckets = histogram
+	seen = 0
+	for bound, n in zip(BUCKETS[:-1], buckets):
+		seen += n
+		if seen >= fraction * count:
+			return bound
+	return None
+
+# summary of the histograms, for the stats page
+def summary():
+	with lock:
+		items = [(name, (h[0], h[1], list(h[2]))) for name, h in histograms.items()]
+	stats = {}
+	for name, histogram in items:
+		count, total, buckets = histogram
+		stats[name] = {
+			'count': count,
+			'total_ms': round(total, 3),
+			'mean_ms': round(total / count, 3),
+			'p50_ms': percentile(histogram, 0.5),
+			'p95_ms': percentile(histogram, 0.95),
+			'p99_ms': percentile(histogram, 0.99),
+			'buckets': dict(('le_%s' % bound, n) for bound, n in zip(BUCKETS, buckets) if n),
+		}
+	return stats
+
+
+# cursor recording the time of each query as 'db'
+class TimedCursor(object):
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def execute(self, sql, params=()):
+		with timer('db'):
+			return self.cursor.execute(sql, params)
+
+	def executemany(self, sql, param_list):
+		with timer('db'):
+			return self.cursor.executemany(sql, param_list)
+
+
+# while open, this thread's default connection hands out timed cursors; on
+# closing it is left as it was
+class timed_queries(object):
+	def __enter__(self):
+		self.connection = connections[DEFAULT_DB_ALIAS]
+		self.saved = self.connection.__dict__.get('cursor')
+		cursor = self.connection.cursor
+		self.connection.cursor = lambda: TimedCursor(cursor())
+		return self
+
+	def __exit__(self, *exc):
+		if self.saved is None:
+			del self.connection.cursor
+		else:
+			self.connection.cursor = self.saved
+
+
+class TimingMiddleware(object):
+	def process_request(self, request):
+		current.breakdown = {}
+		request._timing = time.time()
+		request._timed_queries = timed_queries().__enter__()
+
+	def process_response(self, request, response):
+		queries = getattr(request, '_timed_queries', None)
+		if queries is not None:
+			del request._timed_queries
+			queries.__exit__(None, None, None)
+		breakdown = getattr(current, 'breakdown', None)
+		current.breakdown = None
+		if breakdown is None or not hasattr(request, '_timing'):
+			return response
+		total = (time.time() - request._timing) * 1000
+		record('request', total)
+		response['Server-Timing'] = ', '.join(['%s;dur=%.1f' % (name, ms) for name, (ms, count) in sorted(breakdown.items())]
+			+ ['total;dur=%.1f' % total])
+		log.info(json.dumps({
+			'method': request.method,
+			'path': request.path,
+			'status': response.status_code,
+			'total_ms': round(total, 1),
+			'timings': dict((name, {'ms': round(ms, 1), 'count': count}) for name, (ms, count) in breakdown.items()),
+		}, sort_keys=True))
+		return response
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from generator.views import append_text
+
+import codecs
+
+
+class Command(BaseCommand):
+	args = '<text_id> <file>'
+	help = 'Appends the contents of a utf-8 file to a saved text, updating its model incrementally'
+
+	def handle(self, *args, **options):
+		if len(args) != 2:
+			raise CommandError('usage: manage.py append_text %s' % self.args)
+		text_id, filename = args
+		with codecs.open(filename, encoding='utf-8') as f:
+			more = f.read()
+		text = append_text(text_id, more)
+		self.stdout.write('text %s is now %d characters long' % (text.pk, len(text.content)))
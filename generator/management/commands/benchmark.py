@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from generator.benchmarks import BENCHMARKS
+
+from datetime import datetime
+import json
+import subprocess
+import sys
+
+
+# git revision of the working tree, if there is one
+def revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+class Command(BaseCommand):
+	args = '[benchmark ...]'
+	help = 'Runs generator benchmarks (all of them if none are named): %s' % ', '.join(sorted(BENCHMARKS))
+	option_list = BaseCommand.option_list + (
+		make_option('--json', dest='json', default=None,
+			help='Write the results to this file as JSON'),
+		make_option('--compare', default=None,
+			help='Show the change from results written earlier with --json'),
+	)
+
+	def handle(self, *names, **options):
+		for name in names:
+			if name not in BENCHMARKS:
+				raise CommandError("unknown benchmark '%s'" % name)
+		previous = {}
+		if options['compare']:
+			with open(options['compare']) as f:
+				for result in json.load(f)['results']:
+					previous[result['benchmark'], result['label']] = result['value']
+		results = []
+		for name in names or sorted(BENCHMARKS):
+			for label, value, unit in BENCHMARKS[name]():
+				line = '%s %s: %.3f %s' % (name, label, value, unit)
+				old = previous.get((name, label))
+				if old:
+					line += ' (was %.3f, %+.1f%%)' % (old, (value - old) * 100.0 / old)
+				self.stdout.write(line)
+				results.append({'benchmark': name, 'label': label, 'value': value, 'unit': unit})
+		if options['json']:
+			with open(options['json'], 'w') as f:
+				json.dump({'revision': revision(), 'python': sys.version.split()[0],
+					'created': datetime.utcnow().isoformat(), 'results': results}, f, indent=1)
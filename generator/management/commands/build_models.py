@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from generator.markov import ArrayMarkovModel
+from generator.models import Text, ModelArtifact, ORDER
+
+
+class Command(BaseCommand):
+	help = 'Builds stored markov model artifacts for texts that are missing one'
+	option_list = BaseCommand.option_list + (
+		make_option('--order', type='int', default=ORDER,
+			help='Markov order of the artifacts (default %d)' % ORDER),
+		make_option('--force', action='store_true', default=False,
+			help='Rebuild artifacts that already exist'),
+		make_option('--processes', type='int', default=0,
+			help='Processes counting each model (default one per cpu)'),
+	)
+
+	def handle(self, *args, **options):
+		order = options['order']
+		current = ModelArtifact.objects.filter(order=order, format=ArrayMarkovModel.FORMAT)
+		texts = Text.objects.all().order_by('pk')
+		if not options['force']:
+			texts = texts.exclude(pk__in=current.values('text'))
+		built = 0
+		for text in texts.iterator():
+			model = ArrayMarkovModel.from_content(text.content, order, options['processes'])
+			ModelArtifact.objects.save_artifact(text, order, model)
+			built += 1
+			self.stdout.write('built text %d (%d characters)' % (text.pk, len(text.content)))
+		# artifacts in an older format are never read again
+		stale = ModelArtifact.objects.filter(order=order).exclude(format=ArrayMarkovModel.FORMAT)
+		stale.delete()
+		self.stdout.write('%d artifact%s built' % (built, '' if built == 1 else 's'))
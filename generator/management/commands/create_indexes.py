@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+from django.db.models import get_app, get_models
+
+
+class Command(BaseCommand):
+	help = ('Creates the indexes of the generator models on existing tables, which syncdb only '
+		'indexes when it creates them (e.g. the (created, id) index the quotation feeds page by)')
+
+	def handle(self, *args, **options):
+		created = 0
+		for model in get_models(get_app('generator')):
+			for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+				# each in its own transaction, so one already there doesn't
+				# abort the rest
+				try:
+					with transaction.commit_on_success():
+						connection.cursor().execute(sql)
+				except DatabaseError as e:
+					self.stdout.write('skipped %s (%s)' % (sql, e))
+					continue
+				created += 1
+				self.stdout.write(sql)
+		self.stdout.write('%d index%s created' % (created, '' if created == 1 else 'es'))
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from generator.caching import delete
+from generator.markov import ArrayMarkovModel
+from generator.models import Text, ModelArtifact, ORDER
+from generator import modelfile
+
+import codecs
+import gzip
+import multiprocessing
+import os
+import re
+import time
+
+
+# header fields of project gutenberg files, looked for near the top
+HEADER = re.compile(r'^(Title|Author):[ \t]*(.+?)\s*$', re.MULTILINE)
+HEADER_CHARS = 4000
+
+# paths of the files under each of paths, in order
+def files(paths):
+	for path in paths:
+		if not os.path.isdir(path):
+			yield path
+			continue
+		for root, dirs, names in os.walk(path):
+			dirs.sort()
+			for name in sorted(names):
+				if not name.startswith('.'):
+					yield os.path.join(root, name)
+
+def read(path, encoding):
+	raw = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+	with raw:
+		return codecs.getreader(encoding)(raw, errors='replace').read()
+
+# title and author of a file's text: from its header if it has one, else the
+# file name and the default author
+def describe(path, content, author):
+	fields = dict(HEADER.findall(content[:HEADER_CHARS]))
+	name = os.path.basename(path)
+	for extension in ('.gz', '.txt'):
+		if name.endswith(extension):
+			name = name[:-len(extension)]
+	if not isinstance(name, unicode):
+		name = name.decode('utf-8', 'replace')
+	title = fields.get('Title') or name
+	return title[:100], (fields.get('Author') or author)[:100]
+
+# lists of up to size items of items
+def batches(items, size):
+	batch = []
+	for item in items:
+		batch.append(item)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+# runs in a pool process: the stored form of a text's model
+def build_artifact(args):
+	content, order = args
+	return ModelArtifact.objects.encode(ArrayMarkovModel.from_content(content, order))
+
+
+class Command(BaseCommand):
+	args = '<file or directory> [...]'
+	help = 'Imports text files (plain or gzipped) as texts, building their model artifacts in a process pool'
+	option_list = BaseCommand.option_list + (
+		make_option('--user', help='Username the texts are added by (required)'),
+		make_option('--author', default='',
+			help='Author of texts whose header names none'),
+		make_option('--encoding', default='utf-8',
+			help='Encoding of the files (default utf-8)'),
+		make_option('--min-length', type='int', default=500,
+			help='Skip texts shorter than this many characters (default 500)'),
+		make_option('--batch', type='int', default=100,
+			help='Texts inserted per query (default 100)'),
+		make_option('--order', type='int', default=ORDER,
+			help='Markov order of the artifacts (default %d)' % ORDER),
+		make_option('--processes', type='int', default=0,
+			help='Processes building models (default one per cpu)'),
+	)
+
+	def handle(self, *paths, **options):
+		if not paths or not options['user']:
+			raise CommandError('usage: manage.py import_texts --user <username> %s' % self.args)
+		try:
+			user = User.objects.get(username=options['user'])
+		except User.DoesNotExist:
+			raise CommandError('no user %r' % options['user'])
+		for path in paths:
+			if not os.path.exists(path):
+				raise CommandError('no such file or directory: %s' % path)
+		self.order = options['order']
+		self.counts = {'texts': 0, 'chars': 0, 'skipped': 0}
+		pool = multiprocessing.Pool(options['processes'] or None)
+		start = time.time()
+		try:
+			# each batch's models build while the next batch is read and inserted
+			pending = None
+			for batch in batches(self.texts(paths, user, options), options['batch']):
+				self.insert(batch)
+				job = pool.map_async(build_artifact, [(text.content, self.order) for text in batch], chunksize=1)
+				if pending:
+					self.store(*pending)
+				pending = (batch, job)
+			if pending:
+				self.store(*pending)
+		finally:
+			pool.terminate()
+		delete(['txtinfo'])
+
+		elapsed = max(time.time() - start, 1e-6)
+		texts, chars = self.counts['texts'], self.counts['chars']
+		self.stdout.write('imported %d text%s (%.1f MB) in %.1fs: %.1f texts/s, %.2f MB/s; %d skipped' % (
+			texts, '' if texts == 1 else 's', chars / 1e6, elapsed,
+			texts / elapsed, chars / 1e6 / elapsed, self.counts['skipped']))
+
+	# unsaved texts of the files under paths, read one at a time
+	def texts(self, paths, user, options):
+		for path in files(paths):
+			try:
+				content = read(path, options['encoding'])
+			except (IOError, EOFError) as e:
+				self.stderr.write('skipping %s: %s' % (path, e))
+				self.counts['skipped'] += 1
+				continue
+			if len(content) < options['min_length']:
+				self.stderr.write('skipping %s: %d characters' % (path, len(content)))
+				self.counts['skipped'] += 1
+				continue
+			title, author = describe(path, content, options['author'])
+			yield Text(content=content, title=title, author=author, user=user)
+
+	# inserts a batch of texts and sets their primary keys, which bulk_create
+	# leaves unset. no post_save signals are sent, so the caches of the new
+	# ids (left over from deleted texts) are cleared here
+	def insert(self, batch):
+		last = Text.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+		last = last[0] if last else 0
+		Text.objects.bulk_create(batch)
+		# ids are handed out in insertion order; another writer adding texts
+		# for the same user during the import would show up as a mismatch
+		pks = list(Text.objects.filter(pk__gt=last, user=batch[0].user).order_by('pk').values_list('pk', flat=True))
+		if len(pks) != len(batch):
+			raise CommandError('expected %d new texts, found %d' % (len(batch), len(pks)))
+		for text, pk in zip(batch, pks):
+			text.pk = pk
+		delete(sum([['t%d' % pk, 'm%d' % pk, 'mv%d' % pk] for pk in pks], []))
+		directory = getattr(settings, 'MARKOV_MODEL_DIR', None)
+		if directory:
+			for pk in pks:
+				modelfile.remove(directory, pk, ORDER)
+
+	# stores the artifacts built for a batch once they are ready
+	def store(self, batch, job):
+		artifacts = [ModelArtifact(text_id=text.pk, order=self.order, format=ArrayMarkovModel.FORMAT, data=data)
+			for text, data in zip(batch, job.get())]
+		ModelArtifact.objects.bulk_create(artifacts)
+		chars = sum(len(text.content) for text in batch)
+		self.counts['texts'] += len(batch)
+		self.counts['chars'] += chars
+		self.stdout.write('imported texts %d-%d (%d characters)' % (batch[0].pk, batch[-1].pk, chars))
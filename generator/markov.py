@@ -0,0 +1,782 @@
+# markov model storage engines used by Text.generate
+from array import array
+from bisect import bisect_right
+import multiprocessing
+import random
+import re
+import struct
+import sys
+
+# optional: the 'numpy' engine
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class InputError(Exception):
+	pass
+
+
+# base of the character models: each has an order and checks the kgrams
+# (and successor chars) it is asked about against it
+class KgramModel(object):
+	def inputcheck(self, kgram, char=None):
+		if len(kgram) != self.order:
+			raise InputError("kgram is not length %d" %self.order)
+		if type(char) is str:
+			if len(char) != 1:
+				raise InputError("char must be a string of length 1")
+
+
+# offsets in content of the characters that start a sentence: an uppercase
+# letter at the start of the text or after terminal punctuation or a newline
+# (with only whitespace, quotes or brackets in between).
+# with begin and end, only offsets in [begin, end) are listed
+def sentence_starts(content, begin=0, end=None):
+	starts = array('i')
+	i = begin - 1
+	while i >= 0 and (content[i] in '"\'(' or content[i].isspace()) and content[i] != '\n':
+		i -= 1
+	atstart = i < 0 or content[i] in '.!?\n'
+	for i in xrange(begin, len(content) if end is None else end):
+		char = content[i]
+		if char in '.!?\n':
+			atstart = True
+		elif char.isspace() or char in '"\'(':
+			pass
+		else:
+			if atstart and char.isupper():
+				starts.append(i)
+			atstart = False
+	return starts
+
+# changes to the kgram counts of content when added is appended to it: the
+# old wrap-around kgrams (those reading into content[:k]) go, and the kgrams
+# of the appended text and the new wrap-around ones come in
+def count_delta(content, added, k):
+	delta = {}
+	def count(text, end, change):
+		for i in xrange(end):
+			successors = delta.setdefault(text[i:i+k], {})
+			successors[text[i+k]] = successors.get(text[i+k], 0) + change
+	n = len(content)
+	start = max(0, n - k)
+	head = content[:k] if n >= k else (content + added)[:k]
+	count(content[start:] + content[:k], n - start, -1)
+	count(content[start:] + added + head, n - start + len(added), 1)
+	return delta
+
+
+# character based k-order markov model
+class MarkovModel(KgramModel):
+	#constructor creates a kgram dictionary
+	#based on a text or a cached dictionary
+	def __init__(self, content, k, model={}, starts=None):
+		self.order = k
+		self.starts = sentence_starts(content) if starts is None else starts
+		if model:
+			self.model = model
+		else:
+			self.model = {}
+			circulartext = content + content[:k]
+
+			for i in range(len(content)):
+				key = circulartext[i:i+k]
+				nextchar = circulartext[i+k]
+				#insert new key or update value
+				if key not in self.model:
+					self.model[key] = {}
+					self.model[key][nextchar] = 1
+				else:
+					if nextchar not in self.model[key]:
+						self.model[key][nextchar] = 1
+					else:
+						self.model[key][nextchar] += 1
+
+	# applies a count delta (see count_delta) in place
+	def apply(self, delta):
+		for kgram, changes in delta.iteritems():
+			successors = self.model.setdefault(kgram, {})
+			for char, change in changes.iteritems():
+				count = successors.get(char, 0) + change
+				if count:
+					successors[char] = count
+				else:
+					successors.pop(char, None)
+			if not successors:
+				del self.model[kgram]
+
+	# updates the model for added appended to content, touching only the kgrams
+	# around the join
+	def extend(self, content, added):
+		self.apply(count_delta(content, added, self.order))
+		self.starts.extend(sentence_starts(content + added, len(content)))
+
+	# adds the counts of another model, built from a separate text, to this one.
+	# its sentence starts are shifted by length, the length of this model's
+	# text, so they index the two texts concatenated
+	def merge(self, other, length):
+		self.apply(other.model)
+		self.starts.extend(start + length for start in other.starts)
+
+	#returns the # of times a given kgram appears in the original text
+	#or if char is given, the number of times kgram is followed by char in the text
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram)
+
+		if kgram not in self.model:
+			return 0
+		elif char == None:
+			total = 0
+			for nextchar in self.model[kgram]:
+				total += self.model[kgram][nextchar]
+			return total
+		else:
+			return self.model[kgram][char]
+
+	# generates a random character to follow kgram based on frequencies in the original text
+	# one call is one iteration of a Markov chain.
+	def random(self, kgram, rng=None):
+		self.inputcheck(kgram)
+		freq = self.frequency(kgram)
+		if freq == 0:
+			raise InputError("no such kgram")
+		rand = (rng or random).randrange(freq)
+		count = 0
+		for char in self.model[kgram]:
+			count += self.model[kgram][char]
+			if count > rand:
+				return char
+
+	# builds the sampling form of the model: for each kgram, its successor
+	# characters and their running (cumulative) counts
+	def compile(self):
+		table = {}
+		for kgram, successors in self.model.iteritems():
+			chars = ''.join(successors)
+			cumulative = []
+			total = 0
+			for char in chars:
+				total += successors[char]
+				cumulative.append(total)
+			table[kgram] = (chars, cumulative)
+		return CompiledMarkovModel(self.order, table, self.starts)
+
+
+# markov model compiled for sampling: parallel arrays of successor chars and
+# cumulative counts per kgram, so a character is picked with one bisect
+# instead of re-summing and walking the successor dict
+class CompiledMarkovModel(KgramModel):
+	def __init__(self, k, table, starts=None):
+		self.order = k
+		self.table = table
+		self.starts = starts
+
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram)
+
+		if kgram not in self.table:
+			return 0
+		chars, cumulative = self.table[kgram]
+		if char == None:
+			return cumulative[-1]
+		i = chars.find(char)
+		if i < 0:
+			return 0
+		return cumulative[i] - (cumulative[i-1] if i else 0)
+
+	def random(self, kgram, rng=None):
+		try:
+			chars, cumulative = self.table[kgram]
+		except KeyError:
+			self.inputcheck(kgram)
+			raise InputError("no such kgram")
+		return chars[bisect_right(cumulative, (rng or random).randrange(cumulative[-1]))]
+
+
+# array-backed markov model: the sorted kgrams are packed into one string of
+# fixed-width records (a kgram's id is its index), and successor chars and
+# cumulative counts live in flat buffers indexed through offsets.
+# a handful of objects in total instead of a dict and string per kgram.
+class ArrayMarkovModel(KgramModel):
+	# version of the dumps() byte layout
+	FORMAT = 2
+	HEADER = struct.Struct('=iiiiii')
+
+	def __init__(self, k, kgrams, offsets, chars, cumulative, starts=None):
+		self.order = k
+		self.kgrams = kgrams
+		self.offsets = offsets
+		self.chars = chars
+		self.cumulative = cumulative
+		self.starts = starts if starts is not None else array('i')
+
+	@classmethod
+	def from_counts(cls, k, model, starts=None):
+		keys = sorted(model)
+		offsets = array('i', [0])
+		chars = []
+		cumulative = array('i')
+		for kgram in keys:
+			total = 0
+			for char, count in model[kgram].iteritems():
+				total += count
+				chars.append(char)
+				cumulative.append(total)
+			offsets.append(len(chars))
+		return cls(k, u''.join(keys), offsets, u''.join(chars), cumulative, starts)
+
+	@classmethod
+	def from_content(cls, content, k, processes=1):
+		model = parallel_model(content, k, processes)
+		return cls.from_counts(k, model.model, model.starts)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	# id of the first kgram not below kgram; binary search over the packed keys
+	def position(self, kgram):
+		k = self.order
+		lo, hi = 0, len(self)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.kgrams[mid*k:mid*k+k] < kgram:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	# id of kgram, or -1 if it never occurs
+	def find(self, kgram):
+		k = self.order
+		i = self.position(kgram)
+		if i < len(self) and self.kgrams[i*k:i*k+k] == kgram:
+			return i
+		return -1
+
+	# successor counts of kgram id i, as (char, count) pairs
+	def successors(self, i):
+		start, end = self.offsets[i], self.offsets[i+1]
+		previous = 0
+		pairs = []
+		for j in xrange(start, end):
+			pairs.append((self.chars[j], self.cumulative[j] - previous))
+			previous = self.cumulative[j]
+		return pairs
+
+	# new model with a count delta (see count_delta) applied and starts appended.
+	# runs of untouched kgrams are copied over as slices; only kgrams in the
+	# delta are re-counted
+	def apply(self, delta, starts=()):
+		k = self.order
+		kgrams, chars = [], []
+		offsets, cumulative = array('i', [0]), array('i')
+		def copy(a, b):
+			if a >= b:
+				return
+			shift = offsets[-1] - self.offsets[a]
+			kgrams.append(self.kgrams[a*k:b*k])
+			chars.append(self.chars[self.offsets[a]:self.offsets[b]])
+			cumulative.extend(self.cumulative[self.offsets[a]:self.offsets[b]])
+			offsets.extend(array('i', (offset + shift for offset in self.offsets[a+1:b+1])))
+		copied = 0
+		for kgram in sorted(delta):
+			i = self.position(kgram)
+			copy(copied, i)
+			if i < len(self) and self.kgrams[i*k:i*k+k] == kgram:
+				counts = self.successors(i)
+				copied = i + 1
+			else:
+				counts = []
+				copied = i
+			changes = dict(delta[kgram])
+			updated = []
+			for char, count in counts:
+				count += changes.pop(char, 0)
+				if count:
+					updated.append((char, count))
+			updated.extend((char, count) for char, count in changes.iteritems() if count)
+			if updated:
+				total = 0
+				for char, count in updated:
+					total += count
+					chars.append(char)
+					cumulative.append(total)
+				kgrams.append(kgram)
+				offsets.append(offsets[-1] + len(updated))
+		copy(copied, len(self))
+		newstarts = array('i', self.starts)
+		newstarts.extend(starts)
+		return type(self)(k, u''.join(kgrams), offsets, u''.join(chars), cumulative, newstarts)
+
+	# new model for added appended to content (the text this model was built from)
+	def extend(self, content, added):
+		return self.apply(count_delta(content, added, self.order),
+			sentence_starts(content + added, len(content)))
+
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram)
+
+		i = self.find(kgram)
+		if i < 0:
+			return 0
+		start, end = self.offsets[i], self.offsets[i+1]
+		if char == None:
+			return self.cumulative[end-1]
+		j = self.chars.find(char, start, end)
+		if j < 0:
+			return 0
+		return self.cumulative[j] - (self.cumulative[j-1] if j > start else 0)
+
+	def random(self, kgram, rng=None):
+		i = self.find(kgram)
+		if i < 0:
+			self.inputcheck(kgram)
+			raise InputError("no such kgram")
+		start, end = self.offsets[i], self.offsets[i+1]
+		rand = (rng or random).randrange(self.cumulative[end-1])
+		return self.chars[bisect_right(self.cumulative, rand, start, end)]
+
+	# serialized form (native byte order): header with the order, counts and
+	# byte lengths, the offsets, cumulative and sentence start arrays, then
+	# the kgrams and successor chars as utf-8
+	def dumps(self):
+		kgrams = self.kgrams.encode('utf-8')
+		chars = self.chars.encode('utf-8')
+		header = self.HEADER.pack(self.order, len(self.offsets), len(self.cumulative), len(self.starts),
+			len(kgrams), len(chars))
+		return ''.join((header, self.offsets.tostring(), self.cumulative.tostring(), self.starts.tostring(),
+			kgrams, chars))
+
+	@classmethod
+	def loads(cls, data):
+		k, noffsets, ncumulative, nstarts, nkgrams, nchars = cls.HEADER.unpack_from(data)
+		pos = cls.HEADER.size
+		buffers = []
+		for count in (noffsets, ncumulative, nstarts):
+			buf = array('i')
+			buf.fromstring(data[pos:pos + count * buf.itemsize])
+			pos += count * buf.itemsize
+			buffers.append(buf)
+		offsets, cumulative, starts = buffers
+		kgrams = data[pos:pos + nkgrams].decode('utf-8')
+		pos += nkgrams
+		chars = data[pos:pos + nchars].decode('utf-8')
+		return cls(k, kgrams, offsets, chars, cumulative, starts)
+
+	# bytes held by the model's buffers
+	def nbytes(self):
+		buffers = (self.kgrams, self.offsets, self.chars, self.cumulative, self.starts)
+		return sum(sys.getsizeof(buf) for buf in buffers)
+
+
+# ArrayMarkovModel counted and sampled with numpy (when it is installed).
+# the text becomes an array of code points, renumbered densely by an alphabet
+# of the characters it uses; each (kgram, successor) pair is packed into one
+# integer as base-alphabet digits, built up a character at a time like a
+# rolling hash, and np.unique counts the pairs. packing keeps the code point
+# order, so kgrams come out sorted as in from_counts (successors are sorted
+# too, rather than in first-seen order). kgrams too long to pack into 62 bits
+# are re-ranked densely part way
+CODEC, CODE = ('utf-32-le', '<u4') if sys.maxunicode > 0xffff else ('utf-16-le', '<u2')
+PACKED = 1 << 62
+
+class NumpyMarkovModel(ArrayMarkovModel):
+	@classmethod
+	def from_content(cls, content, k):
+		if not content:
+			return cls(k, u'', array('i', [0]), u'', array('i'))
+		codes = numpy.frombuffer(content.encode(CODEC), dtype=CODE)
+		n = len(codes)
+		alphabet = numpy.flatnonzero(numpy.bincount(codes))
+		lookup = numpy.zeros(alphabet[-1] + 1, numpy.int64)
+		lookup[alphabet] = numpy.arange(len(alphabet))
+		ids = lookup[codes]
+		ids = numpy.concatenate((ids, ids[:k]))
+		size = len(alphabet)
+		keys = numpy.zeros(n, numpy.int64)
+		bound = 1
+		for j in range(k + 1):
+			if bound * size >= PACKED:
+				ranks, keys = numpy.unique(keys, return_inverse=True)
+				bound = len(ranks)
+			keys = keys * size + ids[j:j+n]
+			bound *= size
+		order = keys.argsort()
+		keys = keys[order]
+		# each distinct pair: its first place in the sorted keys, and one
+		# position in the text where it occurs
+		bounds = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1], [True])))
+		pairs = keys[bounds[:-1]]
+		where = order[bounds[:-1]]
+		counts = numpy.diff(bounds)
+		# pairs are sorted, so each kgram's successors are a run
+		heads = numpy.flatnonzero(numpy.concatenate(([True], pairs[1:] // size != pairs[:-1] // size)))
+		offsets = numpy.append(heads, len(pairs))
+		# each kgram's text, read from one of its occurrences
+		kgrams = alphabet[ids[where[heads][:, numpy.newaxis] + numpy.arange(k)]]
+		chars = alphabet[ids[where + k]]
+		running = numpy.cumsum(counts)
+		cumulative = running - numpy.repeat(numpy.concatenate(([0], running[heads[1:] - 1])), numpy.diff(offsets))
+		return cls(k, decode(kgrams), intarray(offsets), decode(chars), intarray(cumulative),
+			vector_starts(content, alphabet, ids[:n]))
+
+	def random(self, kgram, rng=None):
+		i = self.find(kgram)
+		if i < 0:
+			self.inputcheck(kgram)
+			raise InputError("no such kgram")
+		start, end = self.offsets[i], self.offsets[i+1]
+		rand = (rng or random).randrange(self.cumulative[end-1])
+		counts = numpy.frombuffer(self.cumulative, dtype=numpy.intc)
+		return self.chars[start + int(counts[start:end].searchsorted(rand, 'right'))]
+
+def intarray(values):
+	buf = array('i')
+	buf.fromstring(values.astype(numpy.intc).tostring())
+	return buf
+
+def decode(codes):
+	return codes.astype(CODE).tostring().decode(CODEC)
+
+# sentence_starts of content, given as ids into its alphabet of code points:
+# a character starts a sentence if it is uppercase and the last character
+# before it that is not skipped over (whitespace, quotes or brackets) is
+# terminal punctuation, or there is none
+def vector_starts(content, alphabet, ids):
+	char = unichr if isinstance(content, unicode) else chr
+	def table(test):
+		return numpy.array([test(char(code)) for code in alphabet], bool)[ids]
+	terminal = table(lambda c: c in '.!?\n')
+	skipped = table(lambda c: c not in '.!?\n' and (c.isspace() or c in '"\'('))
+	upper = table(lambda c: c.isupper())
+	positions = numpy.arange(len(ids))
+	last = numpy.maximum.accumulate(numpy.where(skipped, -1, positions))
+	previous = numpy.concatenate(([-1], last[:-1]))
+	atstart = (previous < 0) | terminal[numpy.maximum(previous, 0)]
+	return intarray(numpy.flatnonzero(upper & atstart))
+
+
+# token models
+#
+# tokenizers split text into tokens that concatenate back to it: single
+# characters, words (with the whitespace after them), or words and
+# punctuation marks separately (hybrid)
+TOKENIZERS = {
+	'char': re.compile(r'.', re.DOTALL),
+	'word': re.compile(r'\S+\s*|\s+', re.UNICODE),
+	'hybrid': re.compile(r"\w+(?:'\w+)*\s*|[^\w\s]\s*|\s+", re.UNICODE),
+}
+
+# token ids are stored as characters, skipping the surrogate range
+SURROGATES = 0xd800
+def idchar(i):
+	return unichr(i if i < SURROGATES else i + 0x800)
+
+def charid(c):
+	i = ord(c)
+	return i if i < SURROGATES else i - 0x800
+
+# markov model over tokens rather than characters, k tokens to a kgram.
+# tokens are interned to ids, and the text becomes a string of one character
+# per id, counted by ArrayMarkovModel; kgrams and successors are such id
+# strings (decode turns them back into text). starts are token indexes
+class TokenMarkovModel(object):
+	def __init__(self, content, k, tokenizer='word'):
+		self.order = k
+		self.tokenizer = tokenizer
+		self.vocab = []
+		ids = {}
+		tokens = []
+		positions = []
+		for match in TOKENIZERS[tokenizer].finditer(content):
+			token = match.group()
+			if token not in ids:
+				ids[token] = idchar(len(self.vocab))
+				self.vocab.append(token)
+			tokens.append(ids[token])
+			positions.append(match.start())
+		self.tokens = u''.join(tokens)
+		if len(self.tokens) < k:
+			raise InputError("text is shorter than %d tokens" % k)
+		# a sentence starts in the token holding its first character
+		starts = array('i', sorted(set(bisect_right(positions, pos) - 1 for pos in sentence_starts(content))))
+		counts = MarkovModel(self.tokens, k, starts=starts)
+		self.model = ArrayMarkovModel.from_counts(k, counts.model, starts)
+		self.starts = self.model.starts
+
+	def __len__(self):
+		return len(self.model)
+
+	def inputcheck(self, kgram, char=None):
+		self.model.inputcheck(kgram, char)
+
+	def frequency(self, kgram, char=None):
+		return self.model.frequency(kgram, char)
+
+	def random(self, kgram, rng=None):
+		return self.model.random(kgram, rng)
+
+	# text of an id string
+	def decode(self, ids):
+		return u''.join(self.vocab[charid(c)] for c in ids)
+
+	# id string of text (whose tokens must all be known)
+	def encode(self, text):
+		ids = dict((token, idchar(i)) for i, token in enumerate(self.vocab))
+		try:
+			return u''.join(ids[match.group()] for match in TOKENIZERS[self.tokenizer].finditer(text))
+		except KeyError:
+			raise InputError("unknown token")
+
+
+# character model builders by engine name (settings.MARKOV_ENGINE)
+ENGINES = {
+	'compiled': lambda content, k: MarkovModel(content, k).compile(),
+	'array': ArrayMarkovModel.from_content,
+}
+# token model builders by tokenizer. these chain words rather than characters,
+# so they are kept apart from the engines, which all answer the same kgrams
+TOKEN_ENGINES = {
+	'word': lambda content, k: TokenMarkovModel(content, k, 'word'),
+	'hybrid': lambda content, k: TokenMarkovModel(content, k, 'hybrid'),
+}
+if numpy is not None:
+	ENGINES['numpy'] = NumpyMarkovModel.from_content
+
+def build_model(content, k, engine='compiled'):
+	return ENGINES[engine](content, k)
+
+
+# parallel model building
+#
+# content is split into shards, one per process. a shard counts the kgrams
+# starting in its range, so it carries the k characters after it (the last
+# one wrapping round to the start of the text, as the circular kgrams do),
+# plus the few characters before it that decide whether it opens a sentence.
+# shards also list each (kgram, char) pair in order of first occurrence, and
+# merging them in text order inserts successors in the same order as the
+# serial loop, so the merged model iterates (and samples) identically
+PARALLEL_MIN = 100000
+
+# counts one shard: the kgrams starting at text[begin:end], their successors,
+# and the sentence starts among them (as offsets into text)
+def count_shard(args):
+	text, k, begin, end = args
+	model = {}
+	firsts = []
+	for i in xrange(begin, end):
+		key = text[i:i+k]
+		nextchar = text[i+k]
+		successors = model.get(key)
+		if successors is None:
+			successors = model[key] = {}
+		if nextchar in successors:
+			successors[nextchar] += 1
+		else:
+			successors[nextchar] = 1
+			firsts.append((key, nextchar))
+	return firsts, model, sentence_starts(text, begin, end)
+
+# MarkovModel of content, counted in shards across a pool of processes
+# (cpu count by default). small texts, and calls from pool processes, which
+# can't start pools of their own, are counted here
+def parallel_model(content, k, processes=None):
+	processes = processes or multiprocessing.cpu_count()
+	if processes == 1 or len(content) < max(PARALLEL_MIN, k) or multiprocessing.current_process().daemon:
+		return MarkovModel(content, k)
+	n = len(content)
+	circulartext = content + content[:k]
+	shards = []
+	offsets = []
+	for shard in range(processes):
+		start, end = n * shard // processes, n * (shard + 1) // processes
+		lo = start - 1
+		while lo > 0 and (content[lo] in '"\'(' or content[lo].isspace()) and content[lo] != '\n':
+			lo -= 1
+		lo = max(lo, 0)
+		shards.append((circulartext[lo:end+k], k, start - lo, end - lo))
+		offsets.append(lo)
+	pool = multiprocessing.Pool(processes)
+	try:
+		results = pool.map(count_shard, shards)
+	finally:
+		pool.terminate()
+	model = {}
+	starts = array('i')
+	for (firsts, counts, shardstarts), offset in zip(results, offsets):
+		for kgram, char in firsts:
+			successors = model.setdefault(kgram, {})
+			successors[char] = successors.get(char, 0) + counts[kgram][char]
+		starts.extend(start + offset for start in shardstarts)
+	return MarkovModel(content, k, model, starts)
+
+
+# suffix array over the rotations of content (the text read circularly, like
+# the circular kgrams in MarkovModel), plus the LCP of neighbouring rotations.
+# every occurrence of a kgram is a contiguous run of the array, and within the
+# run the rotations are grouped by the character that follows the kgram, so
+# one index answers successor queries for any order from 0 to len(content).
+class SuffixArrayIndex(object):
+	def __init__(self, content):
+		self.content = content
+		self.sa = self.rotations(content)
+		self.lcp = self.commonprefixes(content, self.sa)
+		self.starts = sentence_starts(content)
+
+	# arrays pickle as lists of ints; their raw buffers are smaller and load
+	# in one copy
+	def __getstate__(self):
+		return {'content': self.content, 'sa': self.sa.tostring(), 'lcp': self.lcp.tostring(),
+			'starts': self.starts.tostring()}
+
+	def __setstate__(self, state):
+		self.content = state['content']
+		for name in ('sa', 'lcp', 'starts'):
+			buf = array('i')
+			buf.fromstring(state[name])
+			setattr(self, name, buf)
+
+	# rotation start positions in sorted order, by prefix doubling on ranks
+	@staticmethod
+	def rotations(content):
+		n = len(content)
+		sa = sorted(range(n), key=content.__getitem__)
+		rank = [0] * n
+		classes = 0
+		for i in range(n):
+			if i and content[sa[i]] != content[sa[i-1]]:
+				classes += 1
+			rank[sa[i]] = classes
+		h = 1
+		while classes < n - 1 and h < n:
+			key = [rank[i] * n + rank[(i + h) % n] for i in range(n)]
+			sa.sort(key=key.__getitem__)
+			classes = 0
+			for i in range(n):
+				if i and key[sa[i]] != key[sa[i-1]]:
+					classes += 1
+				rank[sa[i]] = classes
+			h *= 2
+		return array('i', sa)
+
+	# lcp[i] = common prefix length of rotations sa[i-1] and sa[i] (Kasai)
+	@staticmethod
+	def commonprefixes(content, sa):
+		n = len(content)
+		rank = array('i', [0]) * n
+		for i in range(n):
+			rank[sa[i]] = i
+		lcp = array('i', [0]) * n
+		h = 0
+		for i in range(n):
+			if rank[i] > 0:
+				j = sa[rank[i] - 1]
+				while h < n and content[(i + h) % n] == content[(j + h) % n]:
+					h += 1
+				lcp[rank[i]] = h
+				if h > 0:
+					h -= 1
+			else:
+				h = 0
+		return lcp
+
+	# first k characters of the rotation starting at i
+	def prefix(self, i, k):
+		n = len(self.content)
+		if i + k <= n:
+			return self.content[i:i+k]
+		return self.content[i:] + self.content[:i+k-n]
+
+	# [lo, hi) range of the suffix array whose rotations start with kgram
+	def interval(self, kgram):
+		k = len(kgram)
+		lo, hi = 0, len(self.sa)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.prefix(self.sa[mid], k) < kgram:
+				lo = mid + 1
+			else:
+				hi = mid
+		start = lo
+		hi = len(self.sa)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.prefix(self.sa[mid], k) <= kgram:
+				lo = mid + 1
+			else:
+				hi = mid
+		return start, lo
+
+	# number of distinct kgrams of order k
+	def distinct(self, k):
+		if not self.sa:
+			return 0
+		return 1 + sum(1 for i in xrange(1, len(self.lcp)) if self.lcp[i] < k)
+
+	def at_order(self, k):
+		if not 0 <= k <= len(self.content):
+			raise InputError("order must be between 0 and %d" %len(self.content))
+		return SuffixArrayModel(self, k)
+
+
+# order-k markov model answered from a SuffixArrayIndex
+class SuffixArrayModel(KgramModel):
+	def __init__(self, index, k):
+		self.index = index
+		self.order = k
+		self.starts = index.starts
+
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram, char)
+		if char != None:
+			kgram += char
+		lo, hi = self.index.interval(kgram)
+		return hi - lo
+
+	def random(self, kgram, rng=None):
+		self.inputcheck(kgram)
+		lo, hi = self.index.interval(kgram)
+		if lo == hi:
+			raise InputError("no such kgram")
+		start = self.index.sa[(rng or random).randrange(lo, hi)]
+		content = self.index.content
+		return content[(start + self.order) % len(content)]
+
+
+# weighted mix of markov models of the same order. counts are combined at
+# sampling time: a source is picked in proportion to weight * count of the
+# kgram, then the character comes from that source, which is the same as
+# sampling from the weighted sum of the counts without ever building it
+class BlendedModel(KgramModel):
+	def __init__(self, models, weights):
+		orders = set(model.order for model in models)
+		if len(orders) != 1:
+			raise InputError("blended models must all have the same order")
+		if len(weights) != len(models):
+			raise InputError("need one weight per model")
+		self.order = orders.pop()
+		self.models = models
+		self.weights = weights
+
+	# weighted count of kgram (followed by char, if given) across the sources
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram)
+		return sum(weight * model.frequency(kgram, char) for model, weight in zip(self.models, self.weights))
+
+	def random(self, kgram, rng=None):
+		rng = rng or random
+		weighted = [weight * model.frequency(kgram) for model, weight in zip(self.models, self.weights)]
+		total = sum(weighted)
+		if total <= 0:
+			raise InputError("no such kgram")
+		rand = rng.random() * total
+		for model, weight in zip(self.models, weighted):
+			rand -= weight
+			if rand < 0 and weight > 0:
+				return model.random(kgram, rng)
+		# rounding left rand at the very top: use the last source with the kgram
+		for model, weight in reversed(zip(self.models, weighted)):
+			if weight > 0:
+				return model.random(kgram, rng)
@@ -0,0 +1,204 @@
+# read-only, memory-mapped markov model files
+#
+# a model file is laid out so it can be sampled straight from the mapping,
+# letting every worker on a host share one page-cache copy:
+#
+#   header       magic, format version, order, kgram count, successor count,
+#                sentence start count
+#   kgram table  sorted kgrams, order * 4 bytes each (utf-32-be, so comparing
+#                the bytes compares code points)
+#   offsets      kgram count + 1 uint32: each kgram's first successor
+#   successors   successor chars, 4 bytes each (utf-32-be)
+#   cumulative   uint32 running successor counts, restarting at each kgram
+#   starts       uint32 offsets of sentence starts in the source text
+#
+# integers are little-endian.
+from generator.markov import InputError, KgramModel
+
+from array import array
+import glob
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+
+
+MAGIC = 'UNCRMKV\0'
+FORMAT = 2
+HEADER = struct.Struct('<8sIIIII')
+UINT = struct.Struct('<I')
+CHARSIZE = 4
+
+
+def uints(values):
+	buf = array('I', values)
+	if sys.byteorder == 'big':
+		buf.byteswap()
+	return buf.tostring()
+
+# writes an ArrayMarkovModel to path; the file is renamed into place so
+# readers never map a partial file
+def write(path, model):
+	k = model.order
+	keys = sorted((model.kgrams[i*k:i*k+k].encode('utf-32-be'), i) for i in xrange(len(model)))
+	offsets = [0]
+	chars = []
+	cumulative = array('I')
+	for encoded, i in keys:
+		start, end = model.offsets[i], model.offsets[i+1]
+		chars.append(model.chars[start:end])
+		cumulative.extend(model.cumulative[start:end].tolist())
+		offsets.append(offsets[-1] + end - start)
+	directory = os.path.dirname(path)
+	fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.tmp')
+	with os.fdopen(fd, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, FORMAT, k, len(keys), offsets[-1], len(model.starts)))
+		f.write(''.join(encoded for encoded, i in keys))
+		f.write(uints(offsets))
+		f.write(u''.join(chars).encode('utf-32-be'))
+		f.write(uints(cumulative))
+		f.write(uints(model.starts))
+	os.rename(tmppath, path)
+
+
+# read-only sequence of uint32s in a mapped file
+class UintTable(object):
+	def __init__(self, map, start, count):
+		self.map = map
+		self.start = start
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		if not 0 <= i < self.count:
+			raise IndexError(i)
+		return UINT.unpack_from(self.map, self.start + i * UINT.size)[0]
+
+
+# markov model sampled directly from a mapped model file
+class MmapMarkovModel(KgramModel):
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.order, self.nkgrams, self.nchars, nstarts = HEADER.unpack_from(self.map)
+		if magic != MAGIC or version != FORMAT:
+			raise InputError("%s is not a version %d model file" % (path, FORMAT))
+		self.kgramstart = HEADER.size
+		self.offsetstart = self.kgramstart + self.nkgrams * self.order * CHARSIZE
+		self.charstart = self.offsetstart + (self.nkgrams + 1) * UINT.size
+		self.cumulativestart = self.charstart + self.nchars * CHARSIZE
+		self.starts = UintTable(self.map, self.cumulativestart + self.nchars * UINT.size, nstarts)
+
+	def __len__(self):
+		return self.nkgrams
+
+	def close(self):
+		self.map.close()
+
+	# id of kgram, or -1 if it never occurs
+	def find(self, kgram):
+		key = kgram.encode('utf-32-be')
+		width = len(key)
+		lo, hi = 0, self.nkgrams
+		while lo < hi:
+			mid = (lo + hi) // 2
+			pos = self.kgramstart + mid * width
+			if self.map[pos:pos+width] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		pos = self.kgramstart + lo * width
+		if lo < self.nkgrams and self.map[pos:pos+width] == key:
+			return lo
+		return -1
+
+	def offset(self, i):
+		return UINT.unpack_from(self.map, self.offsetstart + i * UINT.size)[0]
+
+	def count(self, j):
+		return UINT.unpack_from(self.map, self.cumulativestart + j * UINT.size)[0]
+
+	def char(self, j):
+		pos = self.charstart + j * CHARSIZE
+		return self.map[pos:pos+CHARSIZE].decode('utf-32-be')
+
+	def frequency(self, kgram, char = None):
+		self.inputcheck(kgram)
+
+		i = self.find(kgram)
+		if i < 0:
+			return 0
+		start, end = self.offset(i), self.offset(i+1)
+		if char == None:
+			return self.count(end-1)
+		for j in xrange(start, end):
+			if self.char(j) == char:
+				return self.count(j) - (self.count(j-1) if j > start else 0)
+		return 0
+
+	def random(self, kgram, rng=None):
+		i = self.find(kgram)
+		if i < 0:
+			self.inputcheck(kgram)
+			raise InputError("no such kgram")
+		start, end = self.offset(i), self.offset(i+1)
+		rand = (rng or random).randrange(self.count(end-1))
+		# binary search for the first cumulative count above rand
+		lo, hi = start, end
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.count(mid) <= rand:
+				lo = mid + 1
+			else:
+				hi = mid
+		return self.char(lo)
+
+
+# model files are named by text id, order, file format and the version of the
+# stored model they were written from (see views.model_version), so a host
+# never serves a file written before the model was rebuilt elsewhere
+def path(directory, text_id, order, version):
+	return os.path.join(directory, 'm%d-o%d-f%d-v%s.bin' % (int(text_id), order, FORMAT, version))
+
+# models mapped by this process, by (text_id, order), with the path and file
+# identity they were mapped from so a rewritten file is picked up
+mapped = {}
+
+# mapped model for version of text_id, writing the file from build() if it
+# is missing. another worker may remove the file between the check and the
+# mapping (replacing the version, or on a save); it is then written again
+def open_model(directory, text_id, order, version, build):
+	text_id = int(text_id)
+	filename = path(directory, text_id, order, version)
+	for attempt in range(2):
+		if attempt or not os.path.exists(filename):
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			write(filename, build())
+			remove(directory, text_id, order, keep=filename)
+		try:
+			stat = os.stat(filename)
+			identity = (stat.st_ino, stat.st_mtime)
+			entry = mapped.get((text_id, order))
+			if entry is None or entry[:2] != (filename, identity):
+				model = MmapMarkovModel(filename)
+				if entry is not None:
+					entry[2].close()
+				entry = mapped[text_id, order] = (filename, identity, model)
+			return entry[2]
+		except (OSError, IOError):
+			if attempt:
+				raise
+
+# drops the model files for text_id (e.g. when its content changes), except keep
+def remove(directory, text_id, order, keep=None):
+	for filename in glob.glob(os.path.join(directory, 'm%d-o%d-f%d-v*.bin' % (int(text_id), order, FORMAT))):
+		if filename != keep:
+			try:
+				os.remove(filename)
+			except OSError:
+				pass
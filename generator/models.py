@@ -1,76 +1,32 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.conf import settings
 
+# engines are re-exported here so models pickled before the move still load
+from generator.markov import InputError, MarkovModel, CompiledMarkovModel, ArrayMarkovModel, \
+	SuffixArrayIndex, SuffixArrayModel, BlendedModel, build_model
+from generator import cleanup, instrument, modelfile
+
+import base64
+import itertools
 import random
-import re
-import string
-
-
-# character based k-order markov model
-class MarkovModel(object):
-	#constructor creates a kgram dictionary
-	#based on a text or a cached dictionary
-	def __init__(self, content, k, model={}):
-		self.order = k
-		if model:
-			self.model = model
-		else:
-			self.model = {}
-			circulartext = content + content[:k]
-
-			for i in range(len(content)):
-				key = circulartext[i:i+k]
-				nextchar = circulartext[i+k]
-				#insert new key or update value
-				if key not in self.model:
-					self.model[key] = {}
-					self.model[key][nextchar] = 1
-				else:
-					if nextchar not in self.model[key]:
-						self.model[key][nextchar] = 1
-					else:
-						self.model[key][nextchar] += 1
-
-	def inputcheck(self, kgram, char=None):
-		if len(kgram) != self.order:
-			raise InputError("kgram is not length %d" %self.order)
-		if type(char) is str:
-			if len(char) != 1:
-				raise InputError("char must be a string of length 1")		
-
-	#returns the # of times a given kgram appears in the original text
-	#or if char is given, the number of times kgram is followed by char in the text
-	def frequency(self, kgram, char = None):
-		self.inputcheck(kgram)
-
-		if kgram not in self.model:
-			return 0
-		elif char == None:
-			total = 0
-			for nextchar in self.model[kgram]:
-				total += self.model[kgram][nextchar]
-			return total
-		else:
-			return self.model[kgram][char]
-
-	# generates a random character to follow kgram based on frequencies in the original text
-	# one call is one iteration of a Markov chain.
-	def random(self, kgram):
-		self.inputcheck(kgram)
-		freq = self.frequency(kgram)
-		if freq == 0:
-			raise InputError("no such kgram")
-		rand = random.randrange(freq)
-		count = 0
-		for char in self.model[kgram]:
-			count += self.model[kgram][char]
-			if count > rand:
-				return char
+import zlib
+
+
+# default markov order, and the orders offered on the add page
+ORDER = 6
+ORDERS = range(1, 11)
 
 
 class TextManager(models.Manager):
-	def create_text(self, content, title, author, user):
-		newtext = self.create(content = content, title = title, author = author, user = user)
+	# model, if given, is an already built model of content, stored as its
+	# artifact instead of building another
+	def create_text(self, content, title, author, user, model=None):
+		newtext = self.model(content = content, title = title, author = author, user = user)
+		newtext.built = model
+		newtext.save(force_insert=True)
 		return newtext
 
 # full text model object, source for generated text
@@ -85,16 +41,84 @@ class Text(models.Model):
 	def __unicode__(self):
 		return self.content[:50]
 
+	# appends more to the content and saves; the stored model is updated
+	# incrementally (see save_text_artifact) instead of rebuilt
+	def append(self, more):
+		self.appended = (self.content, more)
+		self.content += more
+		self.save()
+
 	# Markov Chain Text Generator
 	# text generator functions are static methods because they might be called
 	# before text object is generated
 	@staticmethod
-	def generate(order, minlength, content, cachedmodel={}):
-		model = MarkovModel(content, order, cachedmodel)
+	@instrument.timed('generate')
+	def generate(order, minlength, content, cachedmodel={}, rng=None):
+		rng = rng or random.Random()
+		model = Text.loadmodel(order, content, cachedmodel)
+		kgram = Text.startkgram(model, order, content, rng)
+		return Text.chain(model, order, minlength, kgram, rng)
+
+	# generates n quotes from one model load; seed makes the batch reproducible
+	@staticmethod
+	@instrument.timed('generate')
+	def generate_many(order, minlength, content, n, cachedmodel={}, seed=None):
+		rng = random.Random(seed)
+		model = Text.loadmodel(order, content, cachedmodel)
+		quotes = []
+		for i in range(n):
+			kgram = Text.startkgram(model, order, content, rng)
+			quotes.append(Text.chain(model, order, minlength, kgram, rng))
+		return quotes
+
+	# generates from a weighted mix of several sources, given as (content, model,
+	# weight) tuples. a weight is the source's share of the blend: counts are
+	# scaled by weight / len(content) so long texts don't drown out short ones.
+	# the quote starts at a sentence of a source picked by weight
+	@staticmethod
+	@instrument.timed('generate')
+	def generate_blend(order, minlength, sources, rng=None):
+		rng = rng or random.Random()
+		models = [Text.loadmodel(order, content, model) for content, model, weight in sources]
+		weights = [float(weight) / len(content) for content, model, weight in sources]
+		rand = rng.random() * sum(weight for content, model, weight in sources)
+		for (content, model, weight), startmodel in zip(sources, models):
+			rand -= weight
+			if rand < 0:
+				break
+		kgram = Text.startkgram(startmodel, order, content, rng)
+		return Text.chain(BlendedModel(models, weights), order, minlength, kgram, rng)
+
+	# cachedmodel is either a built model (any engine) or a raw kgram dictionary
+	@staticmethod
+	def loadmodel(order, content, cachedmodel={}):
+		if hasattr(cachedmodel, 'random'):
+			return cachedmodel
+		return MarkovModel(content, order, cachedmodel).compile()
 
-		# ad hoc method for choosing a starting point for output text
+	# text of a kgram or successor: token models (see markov.TokenMarkovModel)
+	# deal in token ids
+	@staticmethod
+	def text(model, kgram):
+		decode = getattr(model, 'decode', None)
+		return decode(kgram) if decode else kgram
+
+	# starting point for output text: the kgram at a random sentence start
+	# from the model's index of them
+	@staticmethod
+	def startkgram(model, order, content, rng):
+		# a token model's starts index its own string of token ids
+		content = getattr(model, 'tokens', content)
+		starts = getattr(model, 'starts', None)
+		if starts:
+			pos = starts[rng.randrange(len(starts))]
+			if pos + order <= len(content):
+				return content[pos:pos+order]
+			return content[pos:] + content[:pos+order-len(content)]
+
+		# ad hoc method for models without sentence starts
 		# (semi-randomly start output with a capital letter)
-		rand=random.randrange(len(content))
+		rand=rng.randrange(len(content))
 		kgram = (content+content[:order])[rand:rand+order]
 		# chain kgrams until finding one that starts with a capital letter
 		# limit this process to 100 iterations before reverting to default
@@ -102,53 +126,161 @@ class Text(models.Model):
 			if kgram[0].isupper():
 				break
 			else:
-				nextchar = model.random(kgram)
+				nextchar = model.random(kgram, rng)
 				kgram = kgram[1:] + nextchar
 		if not kgram[0].isupper():
 			kgram=content[:order]
+		return kgram
+
+	# walks the chain from kgram and cleans up the output
+	@staticmethod
+	def chain(model, order, minlength, kgram, rng):
+		return cleanup.clean_text(u''.join(Text.output(model, order, minlength, kgram, rng)))
+
+	# characters of the raw output: kgram and the walk from it
+	@staticmethod
+	def output(model, order, minlength, kgram, rng):
+		pieces = itertools.chain([Text.text(model, kgram)], Text.walk(model, order, minlength, kgram, rng))
+		return itertools.chain.from_iterable(pieces)
 
-		# build output text
-		output = kgram
+	# yields the text generated by walking the chain from kgram: a character
+	# per step, or a token for token models
+	@staticmethod
+	def walk(model, order, minlength, kgram, rng):
 		i = 0
 		#construct text of length at least outputlength, and continue until end of sentence
 		while True:
-			nextchar = model.random(kgram)
-			output += nextchar
+			nextchar = model.random(kgram, rng)
+			piece = Text.text(model, nextchar)
+			yield piece
 			if order !=0:
 				kgram = kgram[1:] + nextchar
-			i += 1
+			i += len(piece)
 			#continue until end of sentence, 
 			if i >= minlength:
-				if nextchar == ('.' or '!' or '?'):
-					break
+				# stop at the first terminator (tokens may carry
+				# whitespace after theirs)
+				end = piece.rstrip()[-1:]
+				if end and end in cleanup.TERMINATORS:
+					return
 				#cut off too-long sentences, unpunctuated blocks
-				elif nextchar == '\n' and i >= minlength * 3:
-					break
+				elif '\n' in piece and i >= minlength * 3:
+					return
 				elif i >= minlength * 6:
-					break
-		# clean output
-
-		# remove unpaired quotation marks
-		pattern = r'(\"(?=\S)[^\"]*(?<=\S)\")|\"'
-		output = re.sub(pattern, lambda m: m.group(1) or '', output)
-		# remove unpaired parentheses
-		# remove unpaired single quotes, leaving apostrophes intact
-		if output[-1] == ('.' or '!' or '?'):
-			return output
-		else:
-			while output[-1] not in string.letters and len(output) > 0:
-				if output[-1] == ('.' or '!' or '?'):
-					return output
-				output = output[:-1]
-			return output + '.'
+					return
+
+	# like generate, but yields the cleaned output in chunks as the chain walks
+	@staticmethod
+	def stream(order, minlength, content, cachedmodel={}, rng=None):
+		rng = rng or random.Random()
+		model = Text.loadmodel(order, content, cachedmodel)
+		kgram = Text.startkgram(model, order, content, rng)
+		return cleanup.chunks(cleanup.clean(Text.output(model, order, minlength, kgram, rng)))
+
 	@staticmethod
-	def generatequote(content, length, cachedmodel={}):
-		ORDER = 6
-		return Text.generate(ORDER, length, content, cachedmodel)
+	def generatequote(content, length, cachedmodel={}, order=ORDER, rng=None):
+		return Text.generate(order, length, content, cachedmodel, rng)
 	@staticmethod
 	def generatemodel(content):
-		ORDER = 6
-		return MarkovModel(content, ORDER).model
+		return build_model(content, ORDER, getattr(settings, 'MARKOV_ENGINE', 'compiled'))
+	# suffix array index: serves a model of any order via index.at_order(k)
+	@staticmethod
+	def generateindex(content):
+		return SuffixArrayIndex(content)
+
+
+class ModelArtifactManager(models.Manager):
+	# builds and stores (or replaces) the serialized model of text at order.
+	# the replacement is one transaction; if another worker stores the same
+	# text's model at the same time, theirs stands
+	def save_artifact(self, text, order=ORDER, model=None):
+		if model is None:
+			with instrument.timer('build'):
+				model = ArrayMarkovModel.from_content(text.content, order,
+					getattr(settings, 'MODEL_BUILD_PROCESSES', 1))
+		data = self.encode(model)
+		try:
+			with transaction.commit_on_success():
+				self.filter(text=text, order=order).delete()
+				self.create(text=text, order=order, format=ArrayMarkovModel.FORMAT, data=data)
+		except IntegrityError:
+			pass
+		return model
+
+	# stored form of an array model
+	@staticmethod
+	def encode(model):
+		return base64.b64encode(zlib.compress(model.dumps()))
+
+	# updates the stored model of text for added appended to content, counting
+	# only the new kgrams; builds it from scratch if there is none yet
+	def extend_artifact(self, text, content, added, order=ORDER):
+		model = self.load(text.pk, order)
+		if model is not None:
+			model = model.extend(content, added)
+		return self.save_artifact(text, order, model)
+
+	# version of the artifact of text at order in the current format, or None:
+	# its id and write time (ids alone may be reused after a delete)
+	def version(self, text_id, order=ORDER):
+		rows = self.filter(text_id=text_id, order=order, format=ArrayMarkovModel.FORMAT).values_list('pk', 'created')
+		if not rows:
+			return None
+		pk, created = rows[0]
+		return '%d-%s' % (pk, created.strftime('%Y%m%d%H%M%S%f'))
+
+	# stored model of text at order in the current format, or None
+	def load(self, text_id, order=ORDER):
+		try:
+			artifact = self.get(text_id=text_id, order=order, format=ArrayMarkovModel.FORMAT)
+		except self.model.DoesNotExist:
+			return None
+		return ArrayMarkovModel.loads(zlib.decompress(base64.b64decode(artifact.data)))
+
+# precomputed markov model of a text, so a cache miss doesn't rescan the content
+# (a side table rather than a Text column so syncdb can add it to existing databases)
+class ModelArtifact(models.Model):
+	text = models.ForeignKey(Text)
+	order = models.IntegerField()
+	format = models.IntegerField()
+	data = models.TextField()
+	created = models.DateTimeField(auto_now=True)
+
+	objects = ModelArtifactManager()
+	class Meta:
+		unique_together = ('text', 'order', 'format')
+	def __unicode__(self):
+		return u'%s (order %d, format %d)' % (self.text, self.order, self.format)
+
+# the content a text was loaded with, to tell edits of it from edits of the
+# title or author. read from __dict__ so a deferred content isn't fetched
+@receiver(post_init, sender=Text)
+def remember_content(sender, instance, **kwargs):
+	instance.saved_content = instance.__dict__.get('content')
+
+# rebuild the default-order artifact whenever a text's content is saved (or
+# extend it after Text.append), and drop its model file so workers map a
+# fresh one. saves that leave the content alone keep both
+@receiver(post_save, sender=Text)
+def save_text_artifact(sender, instance, created, **kwargs):
+	appended = getattr(instance, 'appended', None)
+	built = getattr(instance, 'built', None)
+	instance.built = None
+	if appended:
+		del instance.appended
+		ModelArtifact.objects.extend_artifact(instance, *appended)
+	elif created or instance.saved_content is None or instance.content != instance.saved_content:
+		# a model built for the same content elsewhere (by the background
+		# builds) is stored as is, if it's the kind artifacts hold
+		if not isinstance(built, ArrayMarkovModel) or built.order != ORDER:
+			built = None
+		ModelArtifact.objects.save_artifact(instance, ORDER, built)
+	else:
+		return
+	instance.saved_content = instance.content
+	directory = getattr(settings, 'MARKOV_MODEL_DIR', None)
+	if directory:
+		modelfile.remove(directory, instance.pk, ORDER)
 
 
 class QuotationManager(models.Manager):
@@ -165,5 +297,11 @@ class Quotation(models.Model):
 		return self.quote
 
 	objects = QuotationManager()
+	# feeds are read newest first by (created, id) keyset cursors. syncdb
+	# doesn't add the index to an existing table: run manage.py create_indexes
+	class Meta:
+		index_together = [['created', 'id']]
 
 
+# cache invalidation on saves and deletes, wherever they come from
+from generator import signals
@@ -0,0 +1,33 @@
+# cache invalidation driven by model signals, so saves and deletes from any
+# view, the admin or a management command leave no stale cache behind.
+# each costs a fixed handful of cache operations
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from generator.caching import bump_namespace, delete
+from generator.models import Quotation, Text, ORDER
+from generator import modelfile
+
+
+# a new, edited or deleted quote retires the feeds it appears in
+@receiver(post_save, sender=Quotation)
+@receiver(post_delete, sender=Quotation)
+def quotation_changed(sender, instance, **kwargs):
+	bump_namespace('all')
+	bump_namespace('u%d' % instance.user_id)
+	if instance.text_id:
+		bump_namespace('tq%d' % instance.text_id)
+
+# a text's cached copy, models and the text list go stale with it
+@receiver(post_save, sender=Text)
+@receiver(post_delete, sender=Text)
+def text_changed(sender, instance, **kwargs):
+	delete(['t%d' % instance.pk, 'm%d' % instance.pk, 'mv%d' % instance.pk, 'txtinfo'])
+
+# a deleted text's model file goes too (saves are handled with its artifact)
+@receiver(post_delete, sender=Text)
+def text_deleted(sender, instance, **kwargs):
+	directory = getattr(settings, 'MARKOV_MODEL_DIR', None)
+	if directory:
+		modelfile.remove(directory, instance.pk, ORDER)
@@ -5,7 +5,51 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from StringIO import StringIO
+from unittest import skipIf
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.signals import request_started
+from django.db import connection, connections, reset_queries, DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save
 from django.test import TestCase
+from django.test.utils import override_settings
+
+from generator import builds, caching, cleanup, instrument, markov, modelfile, views
+from generator.markov import ArrayMarkovModel, BlendedModel, SuffixArrayIndex, sentence_starts
+from generator.models import MarkovModel, ModelArtifact, ORDER, Quotation, Text
+
+
+SAMPLE = (u"The world is full of objects, more or less interesting; I do not "
+          u"wish to add any more. Is it? \"Quotation\" and originality!\n"
+          u"A rabbit as king of the ghosts (in the age of reproduction).")
+
+
+class GeneratorTestCase(TestCase):
+    """
+    Starts each test with an empty cache and a user, reader (password pw),
+    and keeps the per-request timing log out of the runner's output.
+    """
+    def setUp(self):
+        timing = logging.getLogger('generator.timing')
+        self.addCleanup(setattr, timing, 'disabled', timing.disabled)
+        timing.disabled = True
+        cache.clear()
+        self.user = User.objects.create_user(username='reader', password='pw')
 
 
 class SimpleTest(TestCase):
@@ -14,3 +58,937 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class CompiledMarkovModelTest(TestCase):
+    def test_frequencies_match_dict_model(self):
+        """
+        The compiled model reports the same counts as the kgram dictionary.
+        """
+        model = MarkovModel(SAMPLE, 3)
+        compiled = model.compile()
+        for kgram, successors in model.model.items():
+            self.assertEqual(compiled.frequency(kgram), model.frequency(kgram))
+            for char in successors:
+                self.assertEqual(compiled.frequency(kgram, char),
+                                 model.frequency(kgram, char))
+        self.assertEqual(compiled.frequency(u'zzz'), 0)
+
+    def test_random_returns_observed_successor(self):
+        model = MarkovModel(SAMPLE, 3)
+        compiled = model.compile()
+        for kgram, successors in model.model.items():
+            self.assertIn(compiled.random(kgram), successors)
+
+    def test_generate_accepts_compiled_model(self):
+        compiled = Text.generatemodel(SAMPLE)
+        quote = Text.generatequote(SAMPLE, 20, compiled)
+        self.assertTrue(quote)
+
+
+class ArrayMarkovModelTest(TestCase):
+    def test_frequencies_match_dict_model(self):
+        """
+        The array engine reports the same counts as the kgram dictionary.
+        """
+        model = MarkovModel(SAMPLE, 4)
+        packed = ArrayMarkovModel.from_counts(4, model.model)
+        self.assertEqual(len(packed), len(model.model))
+        for kgram, successors in model.model.items():
+            self.assertEqual(packed.frequency(kgram), model.frequency(kgram))
+            for char in successors:
+                self.assertEqual(packed.frequency(kgram, char),
+                                 model.frequency(kgram, char))
+                self.assertIn(packed.random(kgram), successors)
+        self.assertEqual(packed.frequency(u'zzzz'), 0)
+        self.assertTrue(packed.nbytes() > 0)
+
+
+class SuffixArrayIndexTest(TestCase):
+    def test_every_order_matches_dict_model(self):
+        """
+        One index answers the same counts as a dict model of each order.
+        """
+        index = SuffixArrayIndex(SAMPLE)
+        for k in (0, 1, 2, 6, 12):
+            model = MarkovModel(SAMPLE, k)
+            view = index.at_order(k)
+            self.assertEqual(index.distinct(k), len(model.model))
+            for kgram, successors in model.model.items():
+                self.assertEqual(view.frequency(kgram), model.frequency(kgram))
+                for char in successors:
+                    self.assertEqual(view.frequency(kgram, char),
+                                     model.frequency(kgram, char))
+                self.assertIn(view.random(kgram), successors)
+
+    def test_periodic_content(self):
+        index = SuffixArrayIndex(u"abab")
+        self.assertEqual(index.at_order(3).frequency(u"aba"), 2)
+        self.assertEqual(index.at_order(1).random(u"a"), u"b")
+
+    def test_generate_at_other_order(self):
+        view = Text.generateindex(SAMPLE).at_order(3)
+        self.assertTrue(Text.generatequote(SAMPLE, 20, view, 3))
+
+
+@override_settings(MARKOV_MODEL_DIR='')
+class ModelArtifactTest(GeneratorTestCase):
+    def test_dumps_roundtrip(self):
+        model = ArrayMarkovModel.from_content(SAMPLE, 5)
+        loaded = ArrayMarkovModel.loads(model.dumps())
+        self.assertEqual(loaded.order, 5)
+        self.assertEqual(loaded.kgrams, model.kgrams)
+        self.assertEqual(loaded.chars, model.chars)
+        self.assertEqual(list(loaded.offsets), list(model.offsets))
+        self.assertEqual(list(loaded.cumulative), list(model.cumulative))
+
+    def test_artifact_written_on_save_and_used_by_cached_model(self):
+        text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        artifact = ModelArtifact.objects.get(text=text)
+        self.assertEqual(artifact.order, ORDER)
+        self.assertEqual(artifact.format, ArrayMarkovModel.FORMAT)
+        cache.clear()
+        with self.assertNumQueries(1):
+            model = views.cached_model(text.pk)
+        self.assertEqual(model.kgrams, ArrayMarkovModel.from_content(SAMPLE, ORDER).kgrams)
+
+    def test_concurrent_artifact_writes_keep_one(self):
+        text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        theirs = ModelArtifact.objects.get(text=text)
+        # another worker stores its artifact between this one's delete and insert
+        def race(sender, instance, **kwargs):
+            pre_save.disconnect(race, sender=ModelArtifact)
+            ModelArtifact.objects.create(text=text, order=ORDER, format=theirs.format, data=theirs.data)
+        pre_save.connect(race, sender=ModelArtifact)
+        self.addCleanup(pre_save.disconnect, race, sender=ModelArtifact)
+        model = ModelArtifact.objects.save_artifact(text)
+        self.assertEqual(ModelArtifact.objects.filter(text=text).count(), 1)
+        self.assertEqual(ModelArtifact.objects.load(text.pk).kgrams, model.kgrams)
+
+    def test_title_edit_keeps_artifact(self):
+        text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        artifact = ModelArtifact.objects.get(text=text)
+        text = Text.objects.get(pk=text.pk)
+        text.title = 'another title'
+        text.save()
+        self.assertEqual(ModelArtifact.objects.get(text=text).created, artifact.created)
+        # a content edit still rebuilds it
+        text.content = SAMPLE * 2
+        text.save()
+        self.assertEqual(ModelArtifact.objects.load(text.pk).kgrams,
+                         ArrayMarkovModel.from_content(SAMPLE * 2, ORDER).kgrams)
+
+    def test_backfill_command(self):
+        text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        ModelArtifact.objects.all().delete()
+        call_command('build_models', stdout=StringIO())
+        self.assertIsNotNone(ModelArtifact.objects.load(text.pk))
+
+
+class ModelFileTest(GeneratorTestCase):
+    def setUp(self):
+        super(ModelFileTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mapped_model_matches_array_model(self):
+        """
+        A model file answers the same counts as the model it was written from.
+        """
+        text = SAMPLE + u" \u00e9t\u00e9 \u201cquoted\u201d"
+        model = ArrayMarkovModel.from_content(text, 3)
+        path = modelfile.path(self.directory, 0, 3, 1)
+        modelfile.write(path, model)
+        mapped = modelfile.MmapMarkovModel(path)
+        self.assertEqual(len(mapped), len(model))
+        for i in range(len(model)):
+            kgram = model.kgrams[i*3:i*3+3]
+            self.assertEqual(mapped.frequency(kgram), model.frequency(kgram))
+            for char in model.chars[model.offsets[i]:model.offsets[i+1]]:
+                self.assertEqual(mapped.frequency(kgram, char), model.frequency(kgram, char))
+            self.assertTrue(model.frequency(kgram, mapped.random(kgram)) > 0)
+        self.assertEqual(mapped.frequency(u'zzz'), 0)
+        mapped.close()
+
+    def test_cached_model_maps_file_and_remaps_after_save(self):
+        with self.settings(MARKOV_MODEL_DIR=self.directory):
+            text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+            first = views.cached_model(text.pk)
+            self.assertIsInstance(first, modelfile.MmapMarkovModel)
+            self.assertIs(views.cached_model(text.pk), first)
+            text.content = SAMPLE + u" Objects."
+            text.save()
+            second = views.cached_model(text.pk)
+            self.assertIsNot(second, first)
+            self.assertTrue(second.frequency(u"Objects"[:ORDER]) > 0)
+
+    def test_file_removed_before_mapping_is_rewritten(self):
+        mmap_model = modelfile.MmapMarkovModel
+        self.addCleanup(setattr, modelfile, 'MmapMarkovModel', mmap_model)
+        removed = []
+        # another worker removes the file just before this one maps it
+        def racing(filename):
+            if not removed:
+                removed.append(filename)
+                os.remove(filename)
+            return mmap_model(filename)
+        modelfile.MmapMarkovModel = racing
+        with self.settings(MARKOV_MODEL_DIR=self.directory):
+            text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+            model = views.cached_model(text.pk)
+        self.assertTrue(removed)
+        self.assertTrue(model.frequency(SAMPLE[:ORDER]) > 0)
+
+    def test_other_hosts_see_rebuilt_models(self):
+        with self.settings(MARKOV_MODEL_DIR=self.directory):
+            text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+            first = views.cached_model(str(text.pk))
+            # '01' is the same text, with the same file and keys
+            self.assertIs(views.cached_model('0%d' % text.pk), first)
+            # saved on another host: this one's file is left behind
+            with self.settings(MARKOV_MODEL_DIR=''):
+                text.content = SAMPLE + u" Objects."
+                text.save()
+            second = views.cached_model(text.pk)
+            self.assertIsNot(second, first)
+            self.assertTrue(second.frequency(u"Objects"[:ORDER]) > 0)
+            self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+class ChunkedCacheTest(GeneratorTestCase):
+    def setUp(self):
+        super(ChunkedCacheTest, self).setUp()
+        self.chunksize = caching.CHUNKSIZE
+        caching.CHUNKSIZE = 100
+
+    def tearDown(self):
+        caching.CHUNKSIZE = self.chunksize
+
+    def test_small_value_is_stored_whole(self):
+        stored = caching.stats['stored']
+        self.assertTrue(caching.set_large('small', u'abc'))
+        self.assertEqual(caching.get_large('small'), u'abc')
+        self.assertEqual(caching.stats['stored'], stored + 1)
+
+    def test_large_value_is_chunked(self):
+        value = ArrayMarkovModel.from_content(SAMPLE * 3, 4)
+        chunked = caching.stats['chunked']
+        self.assertTrue(caching.set_large('big', value))
+        self.assertEqual(caching.stats['chunked'], chunked + 1)
+        self.assertEqual(cache.get('big')[0], 'c')
+        self.assertEqual(caching.get_large('big').kgrams, value.kgrams)
+
+    def test_missing_chunk_is_a_miss(self):
+        caching.set_large('big', ArrayMarkovModel.from_content(SAMPLE, 4))
+        kind, token, count = cache.get('big')
+        cache.delete(caching.chunkkeys('big', token, count)[-1])
+        self.assertIsNone(caching.get_large('big'))
+
+    def test_oversize_value_is_rejected(self):
+        rejected = caching.stats['rejected']
+        caching.CHUNKSIZE = 1
+        self.assertFalse(caching.set_large('huge', SAMPLE))
+        self.assertEqual(caching.stats['rejected'], rejected + 1)
+        self.assertIsNone(caching.get_large('huge'))
+
+
+class BatchGenerationTest(GeneratorTestCase):
+    def test_seeded_batches_repeat(self):
+        model = Text.generatemodel(SAMPLE)
+        first = Text.generate_many(ORDER, 20, SAMPLE, 5, model, seed=7)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(first, Text.generate_many(ORDER, 20, SAMPLE, 5, model, seed=7))
+
+    def test_api_returns_batch(self):
+        text = Text.objects.create_text(SAMPLE * 5, 'title', 'author', self.user)
+        self.client.login(username='reader', password='pw')
+        with self.settings(MARKOV_MODEL_DIR=''):
+            response = self.client.get('/api/generate/', {'text_id': text.pk, 'n': 3, 'seed': 1})
+            again = self.client.get('/api/generate/', {'text_id': text.pk, 'n': 3, 'seed': 1})
+        self.assertEqual(response.status_code, 200)
+        quotes = json.loads(response.content)['quotes']
+        self.assertEqual(len(quotes), 3)
+        self.assertEqual(quotes, json.loads(again.content)['quotes'])
+
+    def test_api_rejects_bad_requests(self):
+        self.assertEqual(self.client.get('/api/generate/').status_code, 403)
+        self.client.login(username='reader', password='pw')
+        self.assertEqual(self.client.get('/api/generate/', {'n': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/generate/', {'n': 1000}).status_code, 400)
+        self.assertEqual(self.client.get('/api/generate/', {'content': 'short'}).status_code, 400)
+
+
+class StreamingTest(GeneratorTestCase):
+    def clean(self, text):
+        return u''.join(cleanup.chunks(cleanup.clean(iter(text))))
+
+    def test_cleanup_filters(self):
+        self.assertEqual(self.clean(u'He said "go" and " left'), u'He said "go" and  left.')
+        self.assertEqual(self.clean(u'A "b c'), u'A b c.')
+        self.assertEqual(self.clean(u'Done. \n('), u'Done.')
+
+    def test_cleanup_balances_brackets_and_ends_at_any_terminator(self):
+        self.assertEqual(self.clean(u'a) (b (c) d'), u'a b (c) d.')
+        self.assertEqual(self.clean(u'Really? ,;'), u'Really?')
+        self.assertEqual(self.clean(u'Go (now!) --'), u'Go (now!)')
+        self.assertEqual(self.clean(u'He said "stop!" ('), u'He said "stop!"')
+        self.assertEqual(self.clean(u'Caf\xe9'), u'Caf\xe9.')
+
+    def test_whole_text_cleanup_matches_streaming(self):
+        rng = random.Random(5)
+        for i in range(2000):
+            text = u''.join(rng.choice(u'ab .!?"()\n\xe9,') for j in range(rng.randint(0, 20)))
+            self.assertEqual(cleanup.clean_text(text), self.clean(text), repr(text))
+
+    def test_walk_stops_at_first_terminator(self):
+        model = MarkovModel(u'Wow! Yes? No. ', 1)
+        for seed in range(20):
+            quote = Text.generate(1, 1, u'Wow! Yes? No. ', model, random.Random(seed))
+            self.assertTrue(quote[-1] in u'.!?', quote)
+            self.assertEqual(sum(quote.count(c) for c in u'.!?'), 1, quote)
+
+    def test_stream_matches_generate(self):
+        model = Text.generatemodel(SAMPLE)
+        streamed = u''.join(Text.stream(ORDER, 20, SAMPLE, model, random.Random(3)))
+        self.assertEqual(streamed, Text.generate(ORDER, 20, SAMPLE, model, random.Random(3)))
+
+    def test_stream_api(self):
+        self.client.login(username='reader', password='pw')
+        response = self.client.get('/api/stream/', {'content': SAMPLE * 5, 'seed': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertTrue(b''.join(response.streaming_content))
+
+
+class SentenceStartTest(TestCase):
+    def test_sentence_starts(self):
+        text = u'Alpha beta. Gamma delta!\n"Epsilon" zeta? (Eta) Theta, Iota.'
+        starts = [text[i] for i in sentence_starts(text)]
+        self.assertEqual(starts, list(u'AGEE'))
+
+    def test_starts_survive_storage(self):
+        model = ArrayMarkovModel.from_content(SAMPLE, 4)
+        expected = list(sentence_starts(SAMPLE))
+        self.assertEqual(list(ArrayMarkovModel.loads(model.dumps()).starts), expected)
+        directory = tempfile.mkdtemp()
+        try:
+            path = modelfile.path(directory, 0, 4, 1)
+            modelfile.write(path, model)
+            mapped = modelfile.MmapMarkovModel(path)
+            self.assertEqual(list(mapped.starts), expected)
+            mapped.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_quotes_begin_a_sentence(self):
+        model = Text.generatemodel(SAMPLE)
+        for quote in Text.generate_many(ORDER, 20, SAMPLE, 20, model, seed=5):
+            self.assertTrue(quote.lstrip('"')[0].isupper())
+
+
+class IncrementalUpdateTest(GeneratorTestCase):
+    def assertSameArrayModel(self, model, expected):
+        self.assertEqual(model.kgrams, expected.kgrams)
+        self.assertEqual(list(model.offsets), list(expected.offsets))
+        for i in range(len(expected)):
+            self.assertEqual(dict(model.successors(i)), dict(expected.successors(i)))
+        self.assertEqual(list(model.starts), list(expected.starts))
+
+    def test_extend_matches_rebuild(self):
+        """
+        Extending a model gives the same counts as building it from the
+        appended text, including the circular wrap-around kgrams.
+        """
+        added = u' More text. And "another" sentence!'
+        for k in (0, 1, 3, 6):
+            model = MarkovModel(SAMPLE, k)
+            model.extend(SAMPLE, added)
+            expected = MarkovModel(SAMPLE + added, k)
+            self.assertEqual(model.model, expected.model)
+            self.assertEqual(list(model.starts), list(expected.starts))
+            packed = ArrayMarkovModel.from_content(SAMPLE, k).extend(SAMPLE, added)
+            self.assertSameArrayModel(packed, ArrayMarkovModel.from_content(SAMPLE + added, k))
+
+    def test_merge(self):
+        other = u'Second source. It is short.'
+        model = MarkovModel(SAMPLE, 3)
+        model.merge(MarkovModel(other, 3), len(SAMPLE))
+        expected = MarkovModel(SAMPLE, 3)
+        for kgram, successors in MarkovModel(other, 3).model.items():
+            for char, count in successors.items():
+                expected.model.setdefault(kgram, {})
+                expected.model[kgram][char] = expected.model[kgram].get(char, 0) + count
+        self.assertEqual(model.model, expected.model)
+        self.assertEqual([(SAMPLE + other)[i] for i in model.starts][-2:], [u'S', u'I'])
+
+    def test_append_text_updates_artifact_and_cache(self):
+        text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        with self.settings(MARKOV_MODEL_DIR=''):
+            views.cached_model(text.pk)
+            views.append_text(text.pk, u' Appended. Text.')
+            expected = ArrayMarkovModel.from_content(SAMPLE + u' Appended. Text.', ORDER)
+            self.assertSameArrayModel(ModelArtifact.objects.load(text.pk), expected)
+            self.assertSameArrayModel(views.cached_model(text.pk), expected)
+        self.assertEqual(Text.objects.get(pk=text.pk).content, SAMPLE + u' Appended. Text.')
+
+
+class BlendedModelTest(GeneratorTestCase):
+    def test_blend_combines_counts(self):
+        first = MarkovModel(SAMPLE, 2).compile()
+        second = MarkovModel(u'The theory of the thing.', 2).compile()
+        blended = BlendedModel([first, second], [1, 3])
+        self.assertEqual(blended.frequency(u'th'),
+                         first.frequency(u'th') + 3 * second.frequency(u'th'))
+        rng = random.Random(0)
+        for i in range(100):
+            self.assertTrue(blended.frequency(u'Th', blended.random(u'Th', rng)) > 0)
+        # a kgram found in only one source comes from that source
+        self.assertEqual(blended.random(u'eo'), u'r')
+
+    def test_generate_blend_and_view(self):
+        one = Text.objects.create_text(SAMPLE, 'one', '', self.user)
+        two = Text.objects.create_text(u'The theory of the thing. ' * 30, 'two', '', self.user)
+        sources = [(SAMPLE, Text.generatemodel(SAMPLE), 1),
+                   (two.content, Text.generatemodel(two.content), 2)]
+        self.assertTrue(Text.generate_blend(ORDER, 20, sources, random.Random(1)))
+        self.client.login(username='reader', password='pw')
+        response = self.client.get('/blend/', {'w%d' % one.pk: '1', 'w%d' % two.pk: '2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['quote'])
+        response = self.client.get('/blend/', {'w%d' % one.pk: 'x'})
+        self.assertTrue(response.context['error'])
+
+
+class ListingQueryTest(GeneratorTestCase):
+    def setUp(self):
+        super(ListingQueryTest, self).setUp()
+        self.text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+        self.client.login(username='reader', password='pw')
+
+    def add_quotes(self, n):
+        for i in range(n):
+            Quotation.objects.create_quotation(u'quote %d' % i, self.user, self.text)
+
+    def count_queries(self, url):
+        cache.clear()
+        connection.use_debug_cursor = True
+        # the query log is otherwise cleared when the request starts
+        request_started.disconnect(reset_queries)
+        try:
+            start = len(connection.queries)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries) - start
+        finally:
+            request_started.connect(reset_queries)
+            connection.use_debug_cursor = False
+
+    def test_constant_queries_per_page(self):
+        """
+        Listing pages cost the same number of queries however many quotes
+        they show.
+        """
+        for url in ('/objects/', '/objects/urtexts/', '/objects/%d' % self.text.pk):
+            counts = []
+            for n in (1, 4, 20):
+                self.add_quotes(n)
+                counts.append(self.count_queries(url))
+            self.assertEqual(len(set(counts)), 1, (url, counts))
+
+    def test_rows_carry_text_and_username(self):
+        self.add_quotes(1)
+        row = views.all_quotes().quotes[0]
+        self.assertEqual((row.quote, row.text_id, row.username), (u'quote 0', self.text.pk, u'reader'))
+        response = self.client.get('/objects/%d' % self.text.pk)
+        self.assertContains(response, '/objects/urtexts/reader')
+
+
+class FeedPaginationTest(GeneratorTestCase):
+    def setUp(self):
+        super(FeedPaginationTest, self).setUp()
+        self.quotes = [Quotation.objects.create_quotation(u'quote %d' % i, self.user)
+                       for i in range(12)]
+
+    def ids(self, page):
+        return [row.id for row in page.quotes]
+
+    def test_walk_feed_both_ways(self):
+        newest = [q.id for q in reversed(self.quotes)]
+        first = views.all_quotes()
+        self.assertEqual(self.ids(first), newest[:5])
+        self.assertIsNone(first.newer)
+        second = views.all_quotes(after=first.older)
+        self.assertEqual(self.ids(second), newest[5:10])
+        third = views.all_quotes(after=second.older)
+        self.assertEqual(self.ids(third), newest[10:])
+        self.assertIsNone(third.older)
+        self.assertEqual(self.ids(views.all_quotes(before=third.newer)), newest[5:10])
+        self.assertEqual(self.ids(views.all_quotes(before=second.newer)), newest[:5])
+
+    def test_new_quote_leaves_older_pages_valid(self):
+        second = views.all_quotes(after=views.all_quotes().older)
+        Quotation.objects.create_quotation(u'newest', self.user)
+        views.all_quotes(update=True)
+        self.assertEqual(views.all_quotes().quotes[0].quote, u'newest')
+        self.assertEqual(self.ids(views.all_quotes(after=second.older)),
+                         self.ids(views.all_quotes(after=second.older, update=True)))
+
+    def test_bad_cursor_is_first_page(self):
+        self.assertEqual(self.ids(views.all_quotes(after='junk')), self.ids(views.all_quotes()))
+        self.assertEqual(self.ids(views.all_quotes(before='1-x')), self.ids(views.all_quotes()))
+        self.assertEqual(self.ids(views.all_quotes(after='99999999999999999999-1')), self.ids(views.all_quotes()))
+        self.client.login(username='reader', password='pw')
+        self.assertEqual(self.client.get('/objects/', {'after': '99999999999999999999-1'}).status_code, 200)
+
+    def test_cursor_spellings_share_a_key(self):
+        cursor = views.all_quotes().older
+        micros, quote_id = cursor.split('-')
+        self.assertEqual(views.feed_key(None, 'all', after=cursor),
+                         views.feed_key(None, 'all', after=' +0%s-%s' % (micros, quote_id)))
+
+
+@skipIf(connection.vendor != 'sqlite', 'lists indexes from sqlite_master')
+class CreateIndexesTest(TestCase):
+    def test_adds_missing_feed_index(self):
+        sql = connection.creation.sql_indexes_for_fields(
+            Quotation, [Quotation._meta.get_field('created'), Quotation._meta.get_field('id')], no_style())[0]
+        name = re.search(r'CREATE INDEX "(\w+)"', sql).group(1)
+        connection.cursor().execute('DROP INDEX "%s"' % name)
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn(sql, out.getvalue())
+        indexes = [row[0] for row in connection.cursor().execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        self.assertIn(name, indexes)
+        # already there: skipped
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn('0 indexes created', out.getvalue())
+
+
+class CacheInvalidationTest(GeneratorTestCase):
+    def setUp(self):
+        super(CacheInvalidationTest, self).setUp()
+        self.text = Text.objects.create_text(SAMPLE, 'title', 'author', self.user)
+
+    def test_quote_changes_retire_feeds(self):
+        """
+        Saves and deletes made outside the views (e.g. in the admin) show up
+        in every feed without an explicit refresh.
+        """
+        quote = Quotation.objects.create_quotation(u'first', self.user, self.text)
+        self.assertEqual([q.quote for q in views.all_quotes().quotes], [u'first'])
+        self.assertEqual([q.quote for q in views.user_quotes(self.user).quotes], [u'first'])
+        self.assertEqual([q.quote for q in views.text_quotes(self.text)], [u'first'])
+        quote.quote = u'edited'
+        quote.save()
+        self.assertEqual([q.quote for q in views.all_quotes().quotes], [u'edited'])
+        self.assertEqual([q.quote for q in views.text_quotes(self.text)], [u'edited'])
+        quote.delete()
+        self.assertEqual(views.all_quotes().quotes, [])
+        self.assertEqual(views.user_quotes(self.user).quotes, [])
+
+    def test_text_changes_clear_text_caches(self):
+        self.assertEqual(views.get_text(self.text.pk).title, 'title')
+        self.assertEqual([t.title for t in views.text_info()], ['title'])
+        self.text.title = 'retitled'
+        self.text.save()
+        self.assertEqual(views.get_text(self.text.pk).title, 'retitled')
+        self.assertEqual([t.title for t in views.text_info()], ['retitled'])
+
+    def test_namespace_bump_is_constant_work(self):
+        key = caching.namespaced('all', 'a')
+        caching.bump_namespace('all')
+        self.assertNotEqual(caching.namespaced('all', 'a'), key)
+        cache.delete('ns:all')
+        caching.bump_namespace('all')
+        self.assertNotEqual(caching.namespaced('all', 'a'), key)
+
+
+class MemoizeTest(GeneratorTestCase):
+    def setUp(self):
+        super(MemoizeTest, self).setUp()
+        self.calls = []
+        caching.BACKGROUND = False
+
+    def tearDown(self):
+        caching.BACKGROUND = True
+
+    def memoized(self, soft=300):
+        @caching.memoize(lambda n: 'square%d' % n, soft=soft)
+        def square(n):
+            self.calls.append(n)
+            return n * n
+        return square
+
+    def test_cached_until_updated(self):
+        square = self.memoized()
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3])
+        square(3, update=True)
+        self.assertEqual(self.calls, [3, 3])
+
+    def test_stale_value_served_while_one_caller_refreshes(self):
+        square = self.memoized(soft=-1)
+        square.store(0, 3)
+        # the first caller takes the lock and refreshes; while it holds it,
+        # others keep getting the stale value without recomputing
+        cache.add('square3:lock', 1)
+        self.assertEqual(square(3), 0)
+        self.assertEqual(self.calls, [])
+        cache.delete('square3:lock')
+        self.assertEqual(square(3), 0)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(square.peek(3), 9)
+
+    def test_miss_waits_for_the_lock_holder(self):
+        square = self.memoized()
+        cache.add('square3:lock', 1)
+        timer = threading.Timer(0.1, square.store, (u'theirs', 3))
+        timer.start()
+        self.assertEqual(square(3), u'theirs')
+        self.assertEqual(self.calls, [])
+        timer.join()
+
+    def test_waiters_take_over_only_when_the_lock_is_released(self):
+        square = self.memoized()
+        cache.add('square3:lock', 1)
+        timer = threading.Timer(0.2, cache.delete, ('square3:lock',))
+        timer.start()
+        # the holder gave up without storing a value
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3])
+        timer.join()
+
+
+# a backend that can't reach its servers: every get misses and every add fails
+class UnreachableCache(DummyCache):
+    def add(self, *args, **kwargs):
+        return False
+
+
+class UnreachableCacheTest(GeneratorTestCase):
+    def setUp(self):
+        super(UnreachableCacheTest, self).setUp()
+        self.addCleanup(setattr, caching, 'cache', caching.cache)
+        caching.cache = UnreachableCache('unreachable', {})
+
+    def test_memoized_helpers_fall_through_to_the_database(self):
+        Text.objects.create_text(SAMPLE, 't', 'a', self.user)
+        start = time.time()
+        self.assertEqual(len(views.text_info()), 1)
+        self.assertLess(time.time() - start, 1)
+
+    def test_feeds_served_without_namespace_versions(self):
+        Quotation.objects.create_quotation(u'a quote', self.user)
+        self.client.login(username='reader', password='pw')
+        self.assertEqual(self.client.get('/objects/').status_code, 200)
+        self.assertEqual(self.client.get('/objects/urtexts/').status_code, 200)
+
+
+class LocalCacheTest(GeneratorTestCase):
+    def setUp(self):
+        super(LocalCacheTest, self).setUp()
+        caching.localcache.clear()
+
+    def test_evicts_least_recently_used_by_size(self):
+        tier = caching.LocalCache(100)
+        tier.set('a', 'v1', 'A', 40)
+        tier.set('b', 'v1', 'B', 40)
+        self.assertEqual(tier.get('a', 'v1'), 'A')
+        tier.set('c', 'v1', 'C', 40)
+        self.assertIsNone(tier.get('b', 'v1'))
+        self.assertEqual(tier.get('a', 'v1'), 'A')
+        self.assertEqual(tier.nbytes, 80)
+        self.assertEqual(tier.stats['evictions'], 1)
+        # values bigger than the whole tier are not kept
+        tier.set('d', 'v1', 'D', 101)
+        self.assertIsNone(tier.get('d', 'v1'))
+
+    def test_only_served_at_memcached_version(self):
+        tier = caching.LocalCache(100)
+        tier.set('a', 'v1', 'A', 10)
+        self.assertIsNone(tier.get('a', 'v2'))
+        self.assertEqual(len(tier), 0)
+
+    def test_memoized_values_served_locally_until_changed(self):
+        @caching.memoize(lambda n: 'local%d' % n, large=True, local=True)
+        def double(n):
+            return n * 2
+        self.assertEqual(double(4), 8)
+        self.assertEqual(double(4), 8)
+        fetched = caching.stats['hits']
+        self.assertEqual(double(4), 8)
+        self.assertEqual(caching.stats['hits'], fetched)
+        # another worker's write or delete is seen on the next call
+        double.store(10, 4)
+        self.assertEqual(double(4), 10)
+        caching.delete(['local4'])
+        self.assertEqual(double(4), 8)
+
+
+class BackgroundBuildTest(GeneratorTestCase):
+    def test_identical_content_reuses_built_model(self):
+        model = builds.built_model(SAMPLE, 4, 30)
+        self.assertEqual(model.frequency(SAMPLE[:4]), ArrayMarkovModel.from_content(SAMPLE, 4).frequency(SAMPLE[:4]))
+        self.assertEqual(builds.jobs, {})
+        # no wait needed the second time: the finished model is cached
+        self.assertIsNotNone(builds.built_model(SAMPLE, 4))
+        self.assertNotEqual(builds.digest(SAMPLE, 4), builds.digest(SAMPLE, 5))
+
+    def test_finished_build_published_without_asking_again(self):
+        builds.submit(SAMPLE, 5)
+        job = builds.jobs[builds.digest(SAMPLE, 5)]
+        job.wait(30)
+        self.assertTrue(job.ready())
+        # another worker finds it in memcached; the job is gone without a
+        # second built_model call
+        builds.models.clear()
+        self.assertIsNotNone(builds.cached(SAMPLE, 5))
+        self.assertEqual(builds.jobs, {})
+
+    def test_add_page_generates_from_new_text(self):
+        self.client.login(username='reader', password='pw')
+        wait, views.BUILD_WAIT = views.BUILD_WAIT, 30
+        self.addCleanup(setattr, views, 'BUILD_WAIT', wait)
+        response = self.client.post('/add/', {'generate': '1', 'content': SAMPLE * 3, 'title': 't',
+                                              'author': 'a', 'order': '4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['quote'])
+        self.assertIsNotNone(builds.built_model(SAMPLE * 3, 4))
+
+    def test_saved_text_stores_model_built_in_background(self):
+        self.client.login(username='reader', password='pw')
+        model = builds.built_model(SAMPLE * 3, ORDER, 30)
+        def build(*args):
+            raise AssertionError('model built again')
+        self.addCleanup(setattr, ArrayMarkovModel, 'from_content', ArrayMarkovModel.__dict__['from_content'])
+        ArrayMarkovModel.from_content = staticmethod(build)
+        response = self.client.post('/add/', {'content': SAMPLE * 3, 'title': 't', 'author': 'a',
+                                              'quote': 'a quote'})
+        self.assertEqual(response.status_code, 302)
+        text = Text.objects.get(title='t')
+        self.assertEqual(ModelArtifact.objects.load(text.pk).kgrams, model.kgrams)
+
+    def test_other_orders_of_saved_text_use_background_index(self):
+        self.client.login(username='reader', password='pw')
+        text = Text.objects.create_text(SAMPLE * 3, 't', 'a', self.user)
+        wait, views.BUILD_WAIT = views.BUILD_WAIT, 30
+        self.addCleanup(setattr, views, 'BUILD_WAIT', wait)
+        response = self.client.post('/add/', {'generate': '1', 'content': SAMPLE * 3, 'text_id': text.pk,
+                                              'order': '4'})
+        self.assertTrue(response.context['quote'])
+        # built by the pool and cached by content, for every order
+        self.assertIsNotNone(builds.cached(SAMPLE * 3, 0, builds.INDEX))
+        self.assertEqual(views.text_model(text.pk, 3).frequency(SAMPLE[:3]),
+                         ArrayMarkovModel.from_content(SAMPLE * 3, 3).frequency(SAMPLE[:3]))
+
+    def test_indexes_kept_on_disk_when_they_outgrow_the_caches(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.settings(MARKOV_MODEL_DIR=directory):
+            index = SuffixArrayIndex(SAMPLE)
+            builds.remember(SAMPLE, 0, index, builds.INDEX)
+            cache.clear()
+            builds.models.clear()
+            loaded = builds.cached(SAMPLE, 0, builds.INDEX)
+        self.assertEqual(list(loaded.sa), list(index.sa))
+        self.assertEqual(list(loaded.lcp), list(index.lcp))
+        self.assertEqual(list(loaded.starts), list(index.starts))
+        self.assertEqual(loaded.at_order(3).frequency(SAMPLE[:3]), index.at_order(3).frequency(SAMPLE[:3]))
+
+    def test_long_texts_not_indexed_without_a_model_directory(self):
+        text = Text.objects.create_text(SAMPLE * 3, 't', 'a', self.user)
+        limit, views.INDEX_MAX_CHARS = views.INDEX_MAX_CHARS, 100
+        self.addCleanup(setattr, views, 'INDEX_MAX_CHARS', limit)
+        self.client.login(username='reader', password='pw')
+        with self.settings(MARKOV_MODEL_DIR=''):
+            response = self.client.get('/api/generate/', {'text_id': text.pk, 'order': 4})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsaved_models_kept_locally_by_size(self):
+        model = builds.model_for(SAMPLE, 3)
+        self.assertIs(builds.model_for(SAMPLE, 3), model)
+        # still served from this worker with memcached cleared
+        cache.clear()
+        self.assertIs(builds.cached(SAMPLE, 3), model)
+        builds.models.clear()
+        self.assertIsNone(builds.cached(SAMPLE, 3))
+        self.assertLessEqual(builds.models.nbytes, builds.models.maxbytes)
+
+
+class ParallelModelTest(TestCase):
+    def setUp(self):
+        self.threshold, markov.PARALLEL_MIN = markov.PARALLEL_MIN, 0
+
+    def tearDown(self):
+        markov.PARALLEL_MIN = self.threshold
+
+    def test_same_model_as_serial(self):
+        for k in (1, 4):
+            for processes in (2, 5):
+                serial = MarkovModel(SAMPLE, k)
+                parallel = markov.parallel_model(SAMPLE, k, processes)
+                self.assertEqual(parallel.model, serial.model)
+                self.assertEqual(list(parallel.starts), list(serial.starts))
+                # successors come out in the same order, so sampling matches
+                for kgram in serial.model:
+                    self.assertEqual(list(parallel.model[kgram]), list(serial.model[kgram]))
+
+    def test_array_model_from_shards(self):
+        serial = ArrayMarkovModel.from_content(SAMPLE, 3)
+        parallel = ArrayMarkovModel.from_content(SAMPLE, 3, 3)
+        self.assertEqual(parallel.dumps(), serial.dumps())
+
+
+@skipIf(markov.numpy is None, 'numpy is not installed')
+class NumpyMarkovModelTest(TestCase):
+    def test_same_counts_as_dict_model(self):
+        for k in (1, 3, 6):
+            counted = MarkovModel(SAMPLE, k)
+            model = markov.build_model(SAMPLE, k, 'numpy')
+            self.assertEqual(len(model), len(counted.model))
+            for kgram, successors in counted.model.iteritems():
+                self.assertEqual(model.frequency(kgram), counted.frequency(kgram))
+                self.assertEqual(dict(model.successors(model.find(kgram))), successors)
+            self.assertEqual(list(model.starts), list(counted.starts))
+
+    def test_samples_only_seen_successors(self):
+        model = markov.NumpyMarkovModel.from_content(SAMPLE, 2)
+        rng = random.Random(0)
+        for i in range(200):
+            self.assertTrue(model.frequency(u'th', model.random(u'th', rng)) > 0)
+        self.assertRaises(markov.InputError, model.random, u"qq")
+        # incremental updates keep the engine
+        self.assertIsInstance(model.extend(SAMPLE, u' More.'), markov.NumpyMarkovModel)
+
+
+class TokenMarkovModelTest(GeneratorTestCase):
+    def test_tokens_concatenate_to_text(self):
+        for tokenizer in ('char', 'word', 'hybrid'):
+            model = markov.TokenMarkovModel(SAMPLE, 2, tokenizer)
+            self.assertEqual(model.decode(model.tokens), SAMPLE)
+        words = markov.TokenMarkovModel(SAMPLE, 2, 'word')
+        self.assertEqual(words.decode(words.tokens[:3]), u'The world is ')
+        hybrid = markov.TokenMarkovModel(SAMPLE, 2, 'hybrid')
+        self.assertEqual([hybrid.vocab[markov.charid(c)] for c in hybrid.encode(u'objects, more')],
+                         [u'objects', u', ', u'more'])
+
+    def test_counts_interned_tokens(self):
+        model = markov.TokenMarkovModel(u'a b a b a c ', 1, 'word')
+        self.assertEqual(len(model.vocab), 3)
+        self.assertEqual(model.frequency(model.encode(u'a ')), 3)
+        self.assertEqual(model.frequency(model.encode(u'a '), model.encode(u'b ')), 2)
+        # sentence starts are token indexes
+        self.assertEqual(list(markov.TokenMarkovModel(SAMPLE, 2, 'word').starts), [0, 18, 20, 23])
+
+    def test_generates_whole_sentences_of_words(self):
+        model = markov.TOKEN_ENGINES['word'](SAMPLE, 2)
+        for seed in range(10):
+            quote = Text.generate(2, 20, SAMPLE, model, random.Random(seed))
+            self.assertTrue(quote.lstrip('"')[0].isupper())
+            # made of whole words of the text
+            for word in quote.split():
+                self.assertTrue(word in SAMPLE.split() or word.rstrip('.') in SAMPLE.split(), quote)
+        streamed = u''.join(Text.stream(2, 20, SAMPLE, model, random.Random(4)))
+        self.assertEqual(streamed, Text.generate(2, 20, SAMPLE, model, random.Random(4)))
+
+    def test_token_models_are_not_engines(self):
+        self.assertNotIn('word', markov.ENGINES)
+        with self.settings(MARKOV_ENGINE='array'):
+            self.assertIsInstance(builds.model_for(SAMPLE, 2, 'word'), markov.TokenMarkovModel)
+
+    def test_generate_api_tokens(self):
+        self.client.login(username='reader', password='pw')
+        response = self.client.get('/api/generate/', {'content': SAMPLE * 3, 'tokens': 'hybrid', 'order': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['quotes']), 1)
+        response = self.client.get('/api/generate/', {'content': SAMPLE * 3, 'tokens': 'bytes'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SeededGenerationTest(GeneratorTestCase):
+    def test_same_seed_same_quote(self):
+        model = Text.generatemodel(SAMPLE)
+        quotes = [Text.generatequote(SAMPLE, 20, model, ORDER, random.Random(8)) for i in range(3)]
+        self.assertEqual(len(set(quotes)), 1)
+        # the module-level generator is left alone
+        random.seed(1)
+        expected = random.random()
+        random.seed(1)
+        Text.generate(ORDER, 20, SAMPLE, model)
+        self.assertEqual(random.random(), expected)
+
+    def test_add_page_seed(self):
+        self.client.login(username='reader', password='pw')
+        text = Text.objects.create_text(SAMPLE * 3, 't', 'a', self.user)
+        post = {'generate': '1', 'content': text.content, 'text_id': text.pk, 'seed': '11'}
+        quotes = set(self.client.post('/add/', post).context['quote'] for i in range(3))
+        self.assertEqual(len(quotes), 1)
+
+
+class InstrumentationTest(GeneratorTestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        self.client.login(username='reader', password='pw')
+
+    def test_timers_fill_histograms(self):
+        before = instrument.histograms.get('test', [0])[0]
+        with instrument.timer('test'):
+            pass
+        instrument.timed('test')(lambda: None)()
+        self.assertEqual(instrument.histograms['test'][0], before + 2)
+        self.assertEqual(instrument.summary()['test']['p50_ms'], 1)
+
+    def test_server_timing_breakdown(self):
+        text = Text.objects.create_text(SAMPLE * 3, 't', 'a', self.user)
+        reset_queries()
+        response = self.client.get('/api/generate/', {'text_id': text.pk, 'seed': 1})
+        names = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        for name in ('cache', 'db', 'generate', 'total'):
+            self.assertIn(name, names)
+        # queries are timed without keeping their sql
+        self.assertEqual(connection.queries, [])
+        # and only during the request
+        self.assertNotIn('cursor', connections[DEFAULT_DB_ALIAS].__dict__)
+
+    def test_stats_for_admins_only(self):
+        self.assertEqual(self.client.get('/stats/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        stats = json.loads(self.client.get('/stats/').content)
+        self.assertIn('request', stats['timings'])
+        self.assertIn('hits', stats['cache'])
+
+
+@override_settings(MARKOV_MODEL_DIR='')
+class ImportTextsTest(GeneratorTestCase):
+    def setUp(self):
+        super(ImportTextsTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content, opener=open):
+        with opener(os.path.join(self.directory, name), 'wb') as f:
+            f.write(content.encode('utf-8'))
+
+    def test_imports_files_and_builds_artifacts(self):
+        self.write('plain.txt', SAMPLE * 3)
+        self.write('book.txt.gz', u'Title: A Book\nAuthor: Someone\n\n' + SAMPLE * 3, gzip.open)
+        self.write('short.txt', u'Too short.')
+        views.text_info()
+        out = StringIO()
+        call_command('import_texts', self.directory, user='reader', batch=1, processes=1,
+            stdout=out, stderr=StringIO())
+        texts = Text.objects.order_by('pk')
+        self.assertEqual([(t.title, t.author) for t in texts], [('A Book', 'Someone'), ('plain', '')])
+        self.assertEqual(texts[1].content, SAMPLE * 3)
+        for text in texts:
+            self.assertEqual(ModelArtifact.objects.load(text.pk).kgrams,
+                ArrayMarkovModel.from_content(text.content, ORDER).kgrams)
+        # bulk inserts send no signals; the text list is cleared anyway
+        self.assertEqual(len(views.text_info()), 2)
+        self.assertIn('imported 2 texts', out.getvalue())
+        self.assertIn('1 skipped', out.getvalue())
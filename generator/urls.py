@@ -8,6 +8,10 @@ urlpatterns = patterns('',
 	url(r'^index2/$', views.index2, name='index2'),
 
 	url(r'^add/$', views.add, name='add'),
+	url(r'^blend/?$', views.blend, name='blend'),
+	url(r'^api/generate/?$', views.generate_api, name='generate_api'),
+	url(r'^api/stream/?$', views.stream_api, name='stream_api'),
+	url(r'^stats/?$', views.stats, name='stats'),
 	url(r'^objects/$', views.objects, name='objects'),
 	url(r'^objects/urtexts/(?P<username>q?[a-zA-Z0-9_-]{3,20})?/?$', views.userquotes, name='userquotes'),
 	url(r'^objects/(?P<text_id>q?\d+)/?$', views.permalink, name='permalink'),
@@ -2,17 +2,27 @@
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.forms import ModelForm
-from django.core.cache import cache
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.utils.timezone import utc
+from django.conf import settings
 #uncreative
-from models import Quotation, Text
+from models import InputError, Quotation, Text, ModelArtifact, ORDER, ORDERS
+from caching import memoize, namespaced
+import modelfile
+import builds
+import instrument
+import caching
 #python
 import re
+import json
 import random
 import logging
 from collections import namedtuple
+from datetime import datetime, timedelta
+
+
+log = logging.getLogger(__name__)
 
 
 #homepage with douglas hueber quotation
@@ -23,101 +33,205 @@ def index2(request):
 	return render(request, "generator/index2.html")
 
 
-#cache quotations, texts, and markov models
-def all_quotes(update = False):
-	key = 'all'
-	quotes = cache.get(key)
-	if quotes is None or update:
-		logging.error("allquote DB Query")
-		quotes = Quotation.objects.all().order_by('-created')
-		quotes = list(quotes)
-		cache.set(key, quotes)
-	return quotes
-
-def user_quotes(user, update = False):
-	key = 'u'+str(user.pk)
-	quotes = cache.get(key)
-	if quotes is None or update:
-		logging.error("userquote DB Query")
-		quotes = Quotation.objects.filter(user=user).order_by('-created')
-		quotes = list(quotes)
-		cache.set(key, quotes)
-	return quotes
-
-def user_by_username(username, update = False):
-	key = 'uname' + username
-	user = cache.get(key)
-	if user is None or update:
-		logging.error("user by name")
-		user = get_object_or_404(User, username=username)
-		cache.set(key, user)
-	return user
-
-def text_quotes(text, update = False):
-	key = 'tq'+str(text.pk)
-	quotes = cache.get(key)
-	if quotes is None or update:
-		logging.error("Textquote DB Query")
-		quotes = Quotation.objects.filter(text=text).order_by('-created')
-		quotes = list(quotes)
-		cache.set(key, quotes)
-	return quotes
-
-def get_text(text_id, update = False):
-	key = 't' + str(text_id)
-	text = cache.get(key)
-	if text is None or update:
-		logging.error("Text DB Query")
-		text = get_object_or_404(Text, pk=text_id)
-		cache.set(key, text)
-	return text
+#quotation listings are cached as rows holding everything the templates
+# show, fetched in one joined query, so rendering a page never goes back to
+# the database for each quote's text or user
+QuoteRow = namedtuple('QuoteRow', 'id quote text_id username created')
+def quote_rows(quotes):
+	rows = quotes.values_list('id', 'quote', 'text_id', 'user__username', 'created')
+	return [QuoteRow(*row) for row in rows]
 
-#cache of markov model dictionary associated with each text
-def cached_model(text_id, update = False):
-	key = 'm' + str(text_id)
-	model = cache.get(key)
-	if model is None or update:
-		logging.error("Model DB Query")
+#quotation feeds are paginated in the database, newest first, with keyset
+# cursors: a cursor names the (created, id) of a quote, and a page holds the
+# quotes just older (after=cursor) or just newer (before=cursor) than it.
+# pages are fetched and cached one at a time, so any page costs the same
+# however long the feed. each feed is a cache namespace, retired as a whole
+# when one of its quotes changes (see signals.py)
+PAGESIZE = 5
+FeedPage = namedtuple('FeedPage', 'quotes newer older')
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+def delta_micros(delta):
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+# largest cursor time: the last microsecond a datetime can hold
+MAX_MICROS = delta_micros(datetime.max.replace(tzinfo=utc) - EPOCH)
+
+def encode_cursor(row):
+	return '%d-%d' % (delta_micros(row.created - EPOCH), row.id)
+
+# (micros, id) of a cursor, or None if it is malformed or out of range
+def parse_cursor(cursor):
+	try:
+		time, quote_id = map(int, cursor.split('-'))
+	except (AttributeError, ValueError):
+		return None
+	if not 0 <= time <= MAX_MICROS or quote_id < 0:
+		return None
+	return time, quote_id
+
+# (created, id) of a cursor, or None if it is malformed
+def decode_cursor(cursor):
+	parsed = parse_cursor(cursor)
+	if parsed is None:
+		return None
+	try:
+		return EPOCH + timedelta(microseconds=parsed[0]), parsed[1]
+	except OverflowError:
+		return None
+
+# pages are keyed by the parsed cursor, so each has one key however its
+# numbers are written
+def feed_key(quotes, key, after = None, before = None):
+	if before and decode_cursor(before):
+		return namespaced(key, 'b%d-%d' % parse_cursor(before))
+	if after and decode_cursor(after):
+		return namespaced(key, 'a%d-%d' % parse_cursor(after))
+	return namespaced(key, 'a')
+
+@memoize(feed_key, soft=60, large=True)
+def feed_page(quotes, key, after = None, before = None):
+	log.debug("feed page DB Query")
+	if before and decode_cursor(before):
+		created, quote_id = decode_cursor(before)
+		newer = quotes.filter(created__gte=created).exclude(created=created, id__lte=quote_id)
+		rows = quote_rows(newer.order_by('created', 'id')[:PAGESIZE+1])
+		# close to the top of the feed: that is just the first page
+		if len(rows) <= PAGESIZE:
+			return feed_page(quotes, key)
+		rows = rows[:PAGESIZE][::-1]
+		return FeedPage(rows, encode_cursor(rows[0]), encode_cursor(rows[-1]))
+
+	cursor = decode_cursor(after) if after else None
+	if cursor:
+		created, quote_id = cursor
+		# a range on created (rather than an OR of the two keys) lets the
+		# database walk the (created, id) index from the cursor
+		quotes = quotes.filter(created__lte=created).exclude(created=created, id__gte=quote_id)
+	rows = quote_rows(quotes.order_by('-created', '-id')[:PAGESIZE+1])
+	older = encode_cursor(rows[PAGESIZE-1]) if len(rows) > PAGESIZE else None
+	rows = rows[:PAGESIZE]
+	newer = encode_cursor(rows[0]) if cursor and rows else None
+	return FeedPage(rows, newer, older)
+
+#cache quotations, texts, and markov models. the helpers are memoized (see
+# caching.memoize): a stale entry is served while one worker refreshes it, and
+# a missing one is computed once while the other workers wait
+def all_quotes(after = None, before = None, update = False):
+	return feed_page(Quotation.objects.all(), 'all', after, before, update = update)
+
+def user_quotes(user, after = None, before = None, update = False):
+	return feed_page(Quotation.objects.filter(user=user), 'u'+str(user.pk), after, before, update = update)
+
+@memoize(lambda username: 'uname' + username)
+def user_by_username(username):
+	log.debug("user by name")
+	return get_object_or_404(User, username=username)
+
+@memoize(lambda text: namespaced('tq'+str(text.pk)))
+def text_quotes(text):
+	log.debug("Textquote DB Query")
+	return quote_rows(Quotation.objects.filter(text=text).order_by('-created'))
+
+@memoize(lambda text_id: 't%d' % int(text_id), soft=60 * 60, large=True, local=True)
+def get_text(text_id):
+	log.debug("Text DB Query")
+	return get_object_or_404(Text, pk=text_id)
+
+#stored markov model of a text: its artifact, built from the content if missing
+def stored_model(text_id, update = False):
+	model = None if update else ModelArtifact.objects.load(text_id)
+	if model is None:
 		text = get_text(text_id)
-		content = text.content
-		model = Text.generatemodel(content)
-		cache.set(key, model)
+		model = ModelArtifact.objects.save_artifact(text)
 	return model
 
+@memoize(lambda text_id: 'm%d' % int(text_id), soft=60 * 60, large=True, local=True)
+def memcached_model(text_id):
+	log.debug("Model DB Query")
+	return stored_model(text_id)
+
+#version of a text's stored model artifact, which every rebuild replaces. a
+# missing artifact is built here, so by one worker while the others wait
+@memoize(lambda text_id: 'mv%d' % int(text_id), soft=60 * 60)
+def model_version(text_id):
+	version = ModelArtifact.objects.version(text_id)
+	if version is None:
+		stored_model(text_id)
+		version = ModelArtifact.objects.version(text_id)
+	return version
+
+#cache of markov model associated with each text. with MARKOV_MODEL_DIR set,
+# this is a read-only view over a memory-mapped model file shared by all the
+# workers on the host, written from the stored artifact; otherwise the model
+# is kept in memcached
+@instrument.timed('model')
+def cached_model(text_id, update = False):
+	directory = getattr(settings, 'MARKOV_MODEL_DIR', None)
+	if directory:
+		if update:
+			stored_model(text_id, update)
+		version = model_version(text_id, update = update)
+		return modelfile.open_model(directory, text_id, ORDER, version, lambda: stored_model(text_id))
+	if update:
+		# rebuilds the stored artifact too
+		model = stored_model(text_id, update)
+		memcached_model.store(model, text_id)
+		return model
+	return memcached_model(text_id)
+
+#longest text indexed for other orders without MARKOV_MODEL_DIR, where a
+# finished index can only be kept in memcached and the local tier (an index
+# takes about ten bytes a character)
+INDEX_MAX_CHARS = 2000000
+
+#markov model of a text at any order: the cached default-order model, or a
+# view of the text's suffix array index for other orders. the index takes
+# seconds to build for a long text, so it is built in the background (see
+# builds.py) and cached by content; None if it isn't ready within wait seconds.
+# raises InputError for a text too long to index
+def text_model(text_id, order = ORDER, wait = 0):
+	if order == ORDER:
+		return cached_model(text_id)
+	content = get_text(text_id).content
+	if not getattr(settings, 'MARKOV_MODEL_DIR', None) and len(content) > INDEX_MAX_CHARS:
+		raise InputError("order %d is only available for texts up to %d characters" % (order, INDEX_MAX_CHARS))
+	index = builds.built_model(content, 0, wait, builds.INDEX)
+	if index is None:
+		return None
+	return index.at_order(order)
+
+#appends more to a saved text, updating the cached text and model in place
+# rather than dropping them to be rebuilt from the whole content
+def append_text(text_id, more):
+	text = get_object_or_404(Text, pk=text_id)
+	content = text.content
+	model = memcached_model.peek(text_id)
+	# saving clears the text's cache entries; they are put back updated below
+	text.append(more)
+	get_text.store(text, text_id)
+	if model is not None and hasattr(model, 'extend'):
+		memcached_model.store(model.extend(content, more), text_id)
+	return text
+
 #cache of text info -- no content, just titles, authors, and ids
 # for add.html page dropdown menu
 TextInfo = namedtuple('TextInfo', 'id title author')
-def text_info(update = False):
-	key = 'txtinfo'
-	info = cache.get(key)
-	if info is None or update:
-		logging.error("txt info db query")
-		texts = Text.objects.all().order_by('-created')
-		info = []
-		for text in texts:
-			textinfo = TextInfo(text.id, text.title, text.author)
-			info.append(textinfo)
-		cache.set(key, info)
+@memoize(lambda: 'txtinfo')
+def text_info():
+	log.debug("txt info db query")
+	texts = Text.objects.all().order_by('-created')
+	info = []
+	for text in texts:
+		textinfo = TextInfo(text.id, text.title, text.author)
+		info.append(textinfo)
 	return info
 
-#pagination helper method
-def paginate(request, quotes):
-	paginator = Paginator(quotes, 5)
-	page = request.GET.get('page')
-	try:
-		quotes = paginator.page(page)
-	except PageNotAnInteger:
-		quotes = paginator.page(1)
-	except EmptyPage:
-		quotes=paginator.page(paginator.num_pages)
-	return quotes
-
 # main page: displays all quotations
 def objects(request):
 	if request.user.is_authenticated():
-		quotes = all_quotes()
-		quotes = paginate(request, quotes)
-		return render(request, "generator/allquotes.html", {'quotes': quotes})
+		page = all_quotes(request.GET.get('after'), request.GET.get('before'))
+		return render(request, "generator/allquotes.html", {'quotes': page.quotes, 'page': page})
 
 	# redirect if user isn't logged in -- could potentially be DRYed
 	else:
@@ -138,9 +252,9 @@ def userquotes(request, username=""):
 			user = user_by_username(username)
 		else:
 			user = request.user
-		quotes = user_quotes(user)
-		quotes = paginate(request, quotes)
-		return render(request, "generator/userquotes.html", {'quotes': quotes, 'username': username})
+		page = user_quotes(user, request.GET.get('after'), request.GET.get('before'))
+		return render(request, "generator/userquotes.html", {'quotes': page.quotes, 'page': page,
+			'username': username})
 
 	#redirect if user isn't logged in
 	else:
@@ -168,6 +282,19 @@ def permalink(request, text_id):
 		return redirect(next)
 
 
+# minimum length (in characters) of generated quotations
+MINLENGTH = 50
+# seconds the add page waits for a model of new text to be built
+BUILD_WAIT = 2
+
+# random generator for one generation: seeded by the seed parameter if it is
+# given (for reproducible output), otherwise fresh, so requests never share one
+def request_rng(params):
+	try:
+		return random.Random(int(params['seed']))
+	except (KeyError, ValueError):
+		return random.Random()
+
 #page for generating random quotations based on texts.
 def add(request):
 
@@ -178,11 +305,11 @@ def add(request):
 				next = '/signup/?next=/add'
 		return redirect(next)
 
-	def render_form(content="", title="", author="", error="", quote = "", text_id=""):
+	def render_form(content="", title="", author="", error="", quote = "", text_id="", order=ORDER):
 		# include text author, titles, and IDs for dropdown menu
 		texts = text_info()
 		return render(request, "generator/add.html", {'content': content, 'title': title, 'author': author,
-			'error': error, 'quote': quote, 'text_id': text_id, 'texts': texts})
+			'error': error, 'quote': quote, 'text_id': text_id, 'texts': texts, 'order': order, 'orders': ORDERS})
 	if request.method == 'POST':
 		# Generate text based on user's input (left side of form)
 		if 'generate' in request.POST:
@@ -190,18 +317,40 @@ def add(request):
 			author = request.POST.get('author')
 			title = request.POST.get('title')
 			text_id = request.POST.get('text_id')
+			try:
+				order = int(request.POST.get('order', ORDER))
+			except ValueError:
+				order = ORDER
+			if order not in ORDERS:
+				order = ORDER
 			if len(content) < 500:
 				error = ("The text you submitted is only {number} character{pl} long.  Please \
 					submit a longer text.".format(number = len(content), pl = 's' if len(content)!=1 else ""))
 				return render_form(error = error)
 			# use a Markov chain to generate a random output based on the input text
-			MINLENGTH = 50
 			if text_id:
-				model = cached_model(text_id)
-				quote = Text.generatequote(content, MINLENGTH, model)
+				# the model's sentence starts are offsets into the stored content
+				source = get_text(text_id).content
+				try:
+					model = text_model(text_id, order, BUILD_WAIT)
+				except InputError as e:
+					return render_form(content = content, title = title, author = author, error = "%s." % e,
+						text_id = text_id, order = order)
+				if model is None:
+					error = "Still indexing this text for order %d. Press generate again in a moment." % order
+					return render_form(content = content, title = title, author = author, error = error,
+						text_id = text_id, order = order)
+				quote = Text.generatequote(source, MINLENGTH, model, order, request_rng(request.POST))
 			else:
-				quote = Text.generatequote(content, MINLENGTH)
-			return render_form(content = content, title = title, author = author, quote = quote, text_id = text_id)
+				# built in the background; identical content reuses the model
+				model = builds.built_model(content, order, BUILD_WAIT)
+				if model is None:
+					error = "Still reading your text. Press generate again in a moment."
+					return render_form(content = content, title = title, author = author, error = error,
+						order = order)
+				quote = Text.generatequote(content, MINLENGTH, model, order, request_rng(request.POST))
+			return render_form(content = content, title = title, author = author, quote = quote, text_id = text_id,
+				order = order)
 
 		# Save user's text and quotations (right side of form)
 		else:
@@ -214,14 +363,11 @@ def add(request):
 			if text_id:
 				text = get_text(text_id)
 			else:
-				text = Text.objects.create_text(content, title, author, request.user)
-				# update cache
-				get_text(text.pk, True)
-				text_info(True)
+				# the model generating from it just built, if it's still around
+				text = Text.objects.create_text(content, title, author, request.user,
+					builds.cached(content, ORDER))
+			# cached feeds and texts are invalidated by the save signals
 			quote = Quotation.objects.create_quotation(quote, request.user, text)
-			text_quotes(text, True)
-			user_quotes(request.user, True)
-			all_quotes(True)
 			return redirect('/objects')
 	else:
 		# generate from existing text
@@ -240,6 +386,124 @@ def add(request):
 		return render_form(content, title, author, text_id=text_id)
 
 
+#page for generating from a weighted blend of saved texts. each text gets a
+# weight field (w<text_id>); texts weighted 0 or left blank are left out
+MAXBLEND = 10
+def blend(request):
+	if not request.user.is_authenticated():
+		next = '/login/?next=/blend'
+		if 'HTTP_REFERER' in request.META:
+			if '/signup' in request.META.get('HTTP_REFERER'):
+				next = '/signup/?next=/blend'
+		return redirect(next)
+
+	texts = text_info()
+	weights = {}
+	error = ""
+	quote = ""
+	for info in texts:
+		weight = request.GET.get('w%d' % info.id, '').strip()
+		if weight:
+			try:
+				weights[info.id] = float(weight)
+			except ValueError:
+				error = "Weights must be numbers."
+	if any(weight < 0 for weight in weights.values()):
+		error = "Weights can't be negative."
+	weights = dict((text_id, weight) for text_id, weight in weights.items() if weight > 0)
+	if len(weights) > MAXBLEND:
+		error = "Please blend at most %d texts." % MAXBLEND
+	if weights and not error:
+		sources = [(get_text(text_id).content, cached_model(text_id), weight)
+			for text_id, weight in sorted(weights.items())]
+		quote = Text.generate_blend(ORDER, MINLENGTH, sources, request_rng(request.GET))
+	rows = [(info, weights.get(info.id, '')) for info in texts]
+	return render(request, "generator/blend.html", {'rows': rows, 'quote': quote, 'error': error})
+
+#source text and model for the generation apis, from a saved text (text_id)
+# or posted content. tokens picks word or hybrid (word and punctuation) chains
+# instead of characters; order then counts tokens.
+# returns (content, model, order, seed), or an error response
+TOKENS = ('char', 'word', 'hybrid')
+def generation_source(request):
+	params = request.POST if request.method == 'POST' else request.GET
+	try:
+		order = int(params.get('order', ORDER))
+		seed = int(params['seed']) if params.get('seed') else None
+	except ValueError:
+		return json_response({'error': 'order and seed must be integers.'}, 400)
+	if order not in ORDERS:
+		return json_response({'error': 'order must be between %d and %d.' % (ORDERS[0], ORDERS[-1])}, 400)
+	tokens = params.get('tokens', 'char')
+	if tokens not in TOKENS:
+		return json_response({'error': 'tokens must be one of %s.' % ', '.join(TOKENS)}, 400)
+	text_id = params.get('text_id')
+	if text_id:
+		content = get_text(text_id).content
+	else:
+		content = params.get('content', '')
+		if len(content) < 500:
+			return json_response({'error': 'content must be at least 500 characters long.'}, 400)
+	if tokens != 'char':
+		model = builds.model_for(content, order, tokens)
+	elif text_id:
+		try:
+			model = text_model(text_id, order, BUILD_WAIT)
+		except InputError as e:
+			return json_response({'error': '%s.' % e}, 400)
+		if model is None:
+			return json_response({'error': 'still indexing this text for order %d; try again in a moment.' % order}, 503)
+	else:
+		model = builds.model_for(content, order)
+	return content, model, order, seed
+
+#json api: generates a batch of n quotes from one model load.
+# pass seed to get a reproducible batch
+MAXBATCH = 100
+def generate_api(request):
+	if not request.user.is_authenticated():
+		return json_response({'error': 'Please log in.'}, 403)
+	params = request.POST if request.method == 'POST' else request.GET
+	try:
+		n = int(params.get('n', 1))
+	except ValueError:
+		return json_response({'error': 'n must be an integer.'}, 400)
+	if not 1 <= n <= MAXBATCH:
+		return json_response({'error': 'n must be between 1 and %d.' % MAXBATCH}, 400)
+	source = generation_source(request)
+	if isinstance(source, HttpResponse):
+		return source
+	content, model, order, seed = source
+	quotes = Text.generate_many(order, MINLENGTH, content, n, model, seed)
+	return json_response({'quotes': quotes, 'seed': seed})
+
+#streaming api: sends one quote as plain text while the chain is still walking
+def stream_api(request):
+	if not request.user.is_authenticated():
+		return json_response({'error': 'Please log in.'}, 403)
+	source = generation_source(request)
+	if isinstance(source, HttpResponse):
+		return source
+	content, model, order, seed = source
+	rng = random.Random(seed)
+	return StreamingHttpResponse(Text.stream(order, MINLENGTH, content, model, rng),
+		content_type = 'text/plain; charset=utf-8')
+
+#admin-only stats: timing histograms (see instrument.py) and cache counters
+def stats(request):
+	if not request.user.is_staff:
+		return json_response({'error': 'Admins only.'}, 403)
+	return json_response({
+		'timings': instrument.summary(),
+		'cache': caching.stats,
+		'localcache': dict(caching.localcache.stats, entries=len(caching.localcache), bytes=caching.localcache.nbytes),
+		'adhoc': dict(builds.models.stats, entries=len(builds.models), bytes=builds.models.nbytes),
+	})
+
+def json_response(data, status = 200):
+	return HttpResponse(json.dumps(data), content_type = 'application/json', status = status)
+
+
 USER_RE = re.compile(r"^[a-zA-Z0-9_-]{3,20}$")
 def valid_username(username):
     return username and USER_RE.match(username)
@@ -111,6 +111,8 @@ TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + (
     )
 
 MIDDLEWARE_CLASSES = (
+    # first, so its timings cover the rest
+    'generator.instrument.TimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -156,14 +158,18 @@ LOGGING = {
     'filters': {
         'require_debug_false': {
             '()': 'django.utils.log.RequireDebugFalse'
-        }
+        },
     },
     'handlers': {
         'mail_admins': {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -171,10 +177,21 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # per-request timing breakdowns, one json object per line
+        'generator.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
 
+# storage engine for cached markov models (see generator.markov.ENGINES);
+# 'array' keeps each model in a few flat buffers to save worker memory, and
+# 'numpy' (if numpy is installed) builds the same buffers vectorized
+MARKOV_ENGINE = 'array'
+
 
 # uncomment for production:
 # Parse database configuration from $DATABASE_URL
@@ -199,6 +216,23 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, '../generator/static/generator'),
 )
 
+# directory for memory-mapped markov model files shared by the workers on a
+# host; set MARKOV_MODEL_DIR to an empty string to keep models in memcached
+MARKOV_MODEL_DIR = os.environ.get('MARKOV_MODEL_DIR', '/tmp/uncreative-models')
+
+# bytes of (pickled) texts and models each worker keeps in its own memory in
+# front of memcached
+LOCAL_CACHE_BYTES = int(os.environ.get('LOCAL_CACHE_BYTES', 64 * 1024 * 1024))
+
+# processes per web worker building models of unsaved text (see generator.builds)
+MODEL_BUILD_WORKERS = int(os.environ.get('MODEL_BUILD_WORKERS', 2))
+# bytes of models of unsaved text each web worker keeps
+ADHOC_MODEL_BYTES = int(os.environ.get('ADHOC_MODEL_BYTES', 32 * 1024 * 1024))
+
+# processes counting each stored model of a long text (see
+# generator.markov.parallel_model); 0 for one per cpu
+MODEL_BUILD_PROCESSES = int(os.environ.get('MODEL_BUILD_PROCESSES', 1))
+
 
 os.environ['MEMCACHE_SERVERS'] = os.environ.get('MEMCACHIER_SERVERS', '').replace(',', ';')
 os.environ['MEMCACHE_USERNAME'] = os.environ.get('MEMCACHIER_USERNAME', '')